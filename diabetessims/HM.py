@@ -1,13 +1,13 @@
 import numpy as np
-from scipy.optimize import root_scalar
-import json
-from .utils import ReLU
+from .utils import ReLU, stack_states
+from . import parameters
 
-with open('diabetessims/config.json', 'r') as f:
-    data = json.load(f) #læs json-fil
-    params = data["HM"]
+name = "HM"
 
-params["model"] = "HM"
+def __getattr__(attr):
+    if attr == "params": # read-only parameters from config.json, loaded on first use
+        return parameters.get(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {attr!r}")
 
 def get_FR(p, G = None):
     """Returns FR"""
@@ -19,7 +19,7 @@ def get_F01c(p, G = None):
     """Returns FR"""
     if G is None:
         G = p.G
-    return min(1, G/4.5) * p.F01 * p.BW
+    return np.minimum(1, G/4.5) * p.F01 * p.BW
 
 
 def sys(p, d = 0, uI = 0, uP = 0):
@@ -36,33 +36,85 @@ def sys(p, d = 0, uI = 0, uP = 0):
     -------
     dx (numpy array) : solution to system of differential equations. 
     """
-    G = p.Q1/(p.VG * p.BW)
+    G, Gsc, Q1, Q2, S1, S2, I, x1, x2, x3, D1, D2 = p.x.T # p.x can also be a (N, n_states) batch
+    Gp = Q1/(p.VG * p.BW)
     
 
     D = 1000 * d/p.MwG
 
-    F01c = get_F01c(p, p.G)
-    FR = get_FR(p, p.G)
-
-    UG = p.D2 / p.taus
-    UI = p.S2/p.taus
-
-    dG = (G - p.G)/p.tauig
-    dGsc = (p.G - p.Gsc) / p.tausc
-    dQ1 = UG - F01c - FR - p.x1 * p.Q1 + p.k12 * p.Q2 + p.BW * p.EGP0 * (1 - p.x3)
-    dQ2 = p.Q1 * p.x1 - (p.k12 + p.x2)*p.Q2
-    dS1 = uI - p.S1 / p.taus
-    dS2 = ((p.S1 - p.S2)/p.taus)
-    dI = ((uP + UI) / (p.VI * p.BW) - p.ke * p.I) # Den her kan være wack
-    dx1 = p.kb1 * p.I - p.ka1 * p.x1
-    dx2 = p.kb2 * p.I - p.ka2 * p.x2
-    dx3 = p.kb3 * p.I - p.ka3 * p.x3
-    dD1 = p.AG * D - p.D1 / p.taud
-    dD2 = (p.D1 - p.D2)/p.taud
-    dx = np.array([dG, dGsc, dQ1, dQ2, dS1, dS2, dI, dx1, dx2, dx3, dD1, dD2])
+    F01c = get_F01c(p, G)
+    FR = get_FR(p, G)
+
+    UG = D2 / p.taus
+    UI = S2/p.taus
+
+    dG = (Gp - G)/p.tauig
+    dGsc = (G - Gsc) / p.tausc
+    dQ1 = UG - F01c - FR - x1 * Q1 + p.k12 * Q2 + p.BW * p.EGP0 * (1 - x3)
+    dQ2 = Q1 * x1 - (p.k12 + x2)*Q2
+    dS1 = uI - S1 / p.taus
+    dS2 = ((S1 - S2)/p.taus)
+    dI = ((uP + UI) / (p.VI * p.BW) - p.ke * I) # Den her kan være wack
+    dx1 = p.kb1 * I - p.ka1 * x1
+    dx2 = p.kb2 * I - p.ka2 * x2
+    dx3 = p.kb3 * I - p.ka3 * x3
+    dD1 = p.AG * D - D1 / p.taud
+    dD2 = (D1 - D2)/p.taud
+    dx = np.array([dG, dGsc, dQ1, dQ2, dS1, dS2, dI, dx1, dx2, dx3, dD1, dD2]).T
     return dx
 
 
+def jac(p, d = 0, uI = 0, uP = 0):
+    """
+    Returns Jacobian of sys with respect to the state, J[i, j] = d(dx_i)/d(x_j).
+    Takes the same arguments as sys.
+    """
+    G, Gsc, Q1, Q2, S1, S2, I, x1, x2, x3, D1, D2 = p.x
+    iG, iGsc, iQ1, iQ2, iS1, iS2, iI, ix1, ix2, ix3, iD1, iD2 = range(12)
+    dF01c = p.F01 * p.BW / 4.5 if G < 4.5 else 0 # derivatives of F01c and FR with respect to G
+    dFR = 0.003 * p.VG * p.BW if G > 9 else 0
+    J = np.zeros((12, 12))
+    J[iG, iQ1] = 1/(p.VG * p.BW * p.tauig)
+    J[iG, iG] = -1/p.tauig
+    J[iGsc, iG] = 1/p.tausc
+    J[iGsc, iGsc] = -1/p.tausc
+    J[iQ1, iG] = -dF01c - dFR
+    J[iQ1, iQ1] = -x1
+    J[iQ1, iQ2] = p.k12
+    J[iQ1, ix1] = -Q1
+    J[iQ1, ix3] = -p.BW * p.EGP0
+    J[iQ1, iD2] = 1/p.taus
+    J[iQ2, iQ1] = x1
+    J[iQ2, iQ2] = -(p.k12 + x2)
+    J[iQ2, ix1] = Q1
+    J[iQ2, ix2] = -Q2
+    J[iS1, iS1] = -1/p.taus
+    J[iS2, iS1] = 1/p.taus
+    J[iS2, iS2] = -1/p.taus
+    J[iI, iS2] = 1/(p.taus * p.VI * p.BW)
+    J[iI, iI] = -p.ke
+    J[ix1, iI] = p.kb1
+    J[ix1, ix1] = -p.ka1
+    J[ix2, iI] = p.kb2
+    J[ix2, ix2] = -p.ka2
+    J[ix3, iI] = p.kb3
+    J[ix3, ix3] = -p.ka3
+    J[iD1, iD1] = -1/p.taud
+    J[iD2, iD1] = 1/p.taud
+    J[iD2, iD2] = -1/p.taud
+    return J
+
+def input_jac(p, d = 0, uI = 0, uP = 0):
+    """
+    Returns Jacobian of sys with respect to the inputs.
+    Column 0, 1 and 2 are derivatives with respect to d, uI and uP.
+    """
+    B = np.zeros((12, 3))
+    B[10, 0] = p.AG * 1000/p.MwG # D1
+    B[4, 1] = 1 # S1
+    B[6, 2] = 1/(p.VI * p.BW) # I
+    return B
+
 def steadystate(p, G = None, uI = None, uP = 0):
     if uI is None:
         uI = ssinv(p = p, G = G, uP = uP)
@@ -78,7 +130,7 @@ def ss(p, uI = 0, uP = 0):
     Q1 = G * p.VG * p.BW
     Q2 = x1 * Q1/(p.k12 + x2)
     S = uI * p.taus
-    x0 = np.array([G, G, Q1, Q2, S, S, I, x1, x2, x3, 0, 0])
+    x0 = stack_states(G, G, Q1, Q2, S, S, I, x1, x2, x3, 0, 0)
     return x0
 
 
@@ -97,7 +149,7 @@ def ssinv(p, G = None, uP = 0):
     d = np.sqrt(b**2 - 4*a*c)
     sol1 = (-b + d) / (2 * a)
     sol2 = (-b - d) / (2 * a)
-    I = max(sol1, sol2)
+    I = np.maximum(sol1, sol2)
     uIuP = I * p.VI * p.BW * p.ke
     uI = uIuP - uP
     return uI
@@ -107,15 +159,12 @@ def G_from_u(p, u):
     x1 = p.kb1/p.ka1 * I
     x2 = p.kb2/p.ka2 * I
     x3 = p.kb3/p.ka3 * I
-    G_mat = np.zeros((2,2))
+    # Candidate solutions for k = G < 4.5 (F01c is linear) and c = G > 9 (FR is active)
+    cands, valid = [], []
     for k in range(2):
         for c in range(2):
-            G_mat[k, c] = (-p.F01 * (1-k) + 0.027 * p.VG * c + p.EGP0 * (1 -x3))/(p.F01 / 4.5 * k + p.VG * ( 0.003 * c + x1  - x1*p.k12 /(p.k12 + x2)))
-    # Find valid value
-    G_res = np.empty((2,2), dtype=bool)
-    G_res[0] = G_mat[0] >= 4.5
-    G_res[1] = G_mat[1] <= 4.5
-    G_res[:,0] *= G_mat[:,0] <= 9
-    G_res[:, 1] *= G_mat[:, 1] >= 9
-    G = G_mat[np.where(G_res)][0]
-    return G
+            G = (-p.F01 * (1-k) + 0.027 * p.VG * c + p.EGP0 * (1 -x3))/(p.F01 / 4.5 * k + p.VG * ( 0.003 * c + x1  - x1*p.k12 /(p.k12 + x2)))
+            cands.append(G)
+            valid.append(((G <= 4.5) if k else (G >= 4.5)) & ((G >= 9) if c else (G <= 9)))
+    # First valid candidate, nan if there is none
+    return np.select(valid, cands, np.nan)[()]
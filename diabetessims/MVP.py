@@ -1,11 +1,13 @@
 import numpy as np
-import json
+from .utils import stack_states
+from . import parameters
 
-with open('diabetessims/config.json', 'r') as f:
-    data = json.load(f) #læs json-fil
-    params = data["MVP"]
+name = "MVP"
 
-params["model"] = "MVP"
+def __getattr__(attr):
+    if attr == "params": # read-only parameters from config.json, loaded on first use
+        return parameters.get(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {attr!r}")
 
 def sys(p, d = 0, uI = 0, uP = 0):
     """
@@ -21,17 +23,52 @@ def sys(p, d = 0, uI = 0, uP = 0):
     -------
     dx (numpy array) : solution to system of differential equations. 
     """
-    dD1 = d - p.D1/p.taum
-    dD2 = (p.D1 - p.D2)/p.taum
-    dIsc = uI/(p.tau1 * p.CI) - p.Isc/p.tau1
-    dIp = (p.Isc - p.Ip + uP/p.CI)/p.tau2
-    dIeff = -p.p2 * p.Ieff + p.p2 * p.SI * p.Ip
-    dG = - (p.GEZI + p.Ieff) * p.G + p.EGP0 + 1000/18 * p.D2 / (p.VG * p.taum)
-    dGsc = (p.G - p.Gsc) / p.tausc
-
-    dx = np.array([dD1, dD2, dIsc, dIp, dIeff, dG, dGsc])
+    D1, D2, Isc, Ip, Ieff, G, Gsc = p.x.T # p.x can also be a (N, n_states) batch
+    dD1 = d - D1/p.taum
+    dD2 = (D1 - D2)/p.taum
+    dIsc = uI/(p.tau1 * p.CI) - Isc/p.tau1
+    dIp = (Isc - Ip + uP/p.CI)/p.tau2
+    dIeff = -p.p2 * Ieff + p.p2 * p.SI * Ip
+    dG = - (p.GEZI + Ieff) * G + p.EGP0 + 1000/18 * D2 / (p.VG * p.taum)
+    dGsc = (G - Gsc) / p.tausc
+
+    dx = np.array([dD1, dD2, dIsc, dIp, dIeff, dG, dGsc]).T
     return dx
 
+def jac(p, d = 0, uI = 0, uP = 0):
+    """
+    Returns Jacobian of sys with respect to the state, J[i, j] = d(dx_i)/d(x_j).
+    Takes the same arguments as sys.
+    """
+    D1, D2, Isc, Ip, Ieff, G, Gsc = p.x
+    iD1, iD2, iIsc, iIp, iIeff, iG, iGsc = range(7)
+    J = np.zeros((7, 7))
+    J[iD1, iD1] = -1/p.taum
+    J[iD2, iD1] = 1/p.taum
+    J[iD2, iD2] = -1/p.taum
+    J[iIsc, iIsc] = -1/p.tau1
+    J[iIp, iIsc] = 1/p.tau2
+    J[iIp, iIp] = -1/p.tau2
+    J[iIeff, iIp] = p.p2 * p.SI
+    J[iIeff, iIeff] = -p.p2
+    J[iG, iD2] = 1000/18 / (p.VG * p.taum)
+    J[iG, iIeff] = -G
+    J[iG, iG] = -(p.GEZI + Ieff)
+    J[iGsc, iG] = 1/p.tausc
+    J[iGsc, iGsc] = -1/p.tausc
+    return J
+
+def input_jac(p, d = 0, uI = 0, uP = 0):
+    """
+    Returns Jacobian of sys with respect to the inputs.
+    Column 0, 1 and 2 are derivatives with respect to d, uI and uP.
+    """
+    B = np.zeros((7, 3))
+    B[0, 0] = 1 # D1
+    B[2, 1] = 1/(p.tau1 * p.CI) # Isc
+    B[3, 2] = 1/(p.CI * p.tau2) # Ip
+    return B
+
 def steadystate(p, G = None, uI = None, uP = 0):
     if uI is None:
         uI = ssinv(p = p, G = G, uP = uP)
@@ -40,7 +77,7 @@ def steadystate(p, G = None, uI = None, uP = 0):
     Isc = uI / p.CI
     Ip = Isc + uP / p.CI
     Ieff = p.SI * Ip
-    x0 = np.array([0, 0, Isc, Ip,Ieff, G, G])
+    x0 = stack_states(0, 0, Isc, Ip,Ieff, G, G)
     return x0, uI
 
 def G_from_u(p, u):
@@ -52,7 +89,7 @@ def ss(p, uI = 0, uP = 0):
     Isc = uI / p.CI
     Ip = Isc + uP / p.CI
     Ieff = p.SI * Ip
-    x0 = np.array([0, 0, Isc, Ip,Ieff, G, G])    
+    x0 = stack_states(0, 0, Isc, Ip,Ieff, G, G)
     return x0
 
 def ssinv(p, G = None, uP = 0):
@@ -60,3 +97,44 @@ def ssinv(p, G = None, uP = 0):
         G = p.Gbar
     uI = p.CI/p.SI * (p.EGP0 / G - p.GEZI) - uP
     return uI
+
+def meal_insulin_response(p, ds, uIs, x0):
+    """Euler trajectories of D2 and Ieff as in simulate with inputs ds and uIs (arrays of equal length),
+    no pancreas and initial state x0.
+
+    D1, D2, Isc, Ip and Ieff do not depend on G, and Ieff is affine in uIs, so for a meal they
+    are computed once, and only G is simulated for each bolus (see G_response).
+    Returns arrays of D2 and Ieff of length len(ds) + 1.
+    """
+    D1, D2, Isc, Ip, Ieff = [float(x0[p._idx[key]]) for key in ("D1", "D2", "Isc", "Ip", "Ieff")]
+    taum, tau1, tau2, CI, p2, SI, h = p.taum, p.tau1, p.tau2, p.CI, p.p2, p.SI, p.timestep
+    D2s, Ieffs = [D2], [Ieff]
+    for d, uI in zip(np.asarray(ds, dtype=float).tolist(), np.asarray(uIs, dtype=float).tolist()):
+        dD1 = d - D1/taum
+        dD2 = (D1 - D2)/taum
+        dIsc = uI/(tau1 * CI) - Isc/tau1
+        dIp = (Isc - Ip)/tau2
+        dIeff = -p2 * Ieff + p2 * SI * Ip
+        D1 = max(D1 + dD1 * h, 0)
+        D2 = max(D2 + dD2 * h, 0)
+        Isc = max(Isc + dIsc * h, 0)
+        Ip = max(Ip + dIp * h, 0)
+        Ieff = max(Ieff + dIeff * h, 0)
+        D2s.append(D2)
+        Ieffs.append(Ieff)
+    return np.array(D2s), np.array(Ieffs)
+
+def G_response(p, D2, Ieff, G0):
+    """Euler trajectory of G as in simulate, given the trajectories of D2 and Ieff from meal_insulin_response.
+    Ieff can have shape (m, T + 1) for m insulin inputs, which gives G of shape (m, T + 1)."""
+    GEZI, EGP0, c, h = p.GEZI, p.EGP0, 1000/18, p.timestep
+    VGtaum = p.VG * p.taum
+    Ieff = np.asarray(Ieff)
+    G = np.empty(Ieff.shape)
+    G[..., 0] = G0
+    Gk = G[..., 0].copy()
+    for k, D2k in enumerate(D2[:-1].tolist()):
+        dG = - (GEZI + Ieff[..., k]) * Gk + EGP0 + c * D2k / VGtaum
+        Gk = np.maximum(Gk + dG * h, 0)
+        G[..., k+1] = Gk
+    return G
@@ -2,5 +2,13 @@ from .extendedmodel import *
 from .odeclass import *
 from .pancreas import *
 from .utils import *
+from .batch import *
+from .cache import *
+from .bolustable import *
+from .metrics import *
+from .store import *
+from .schedule import *
+from .surrogate import *
+from . import parameters
 from . import MVP
-from . import HM
\ No newline at end of file
+from . import HM
@@ -0,0 +1,213 @@
+import numpy as np
+from . import utils
+from . import pancreas
+from .extendedmodel import Patient, penalty_funcs
+from .store import SimulationWriter
+
+
+class Stack:
+    """Parameters and states of several ODE objects stacked along the first axis.
+
+    Numeric parameters become arrays with one row per object, and the states are held
+    in x and x0 with shape (N, n_states), so a Stack can be passed as p to the model functions.
+    """
+    def __init__(self, objs):
+        first = objs[0]
+        for obj in objs:
+            if obj.state_keys != first.state_keys:
+                raise ValueError("All objects in a stack must have the same states.")
+        self.size = len(objs)
+        self.state_keys = first.state_keys
+        self.x = np.vstack([obj.x for obj in objs])
+        self.x0 = np.vstack([obj.x0 for obj in objs])
+        self._stack_params([obj.__dict__ for obj in objs])
+
+    @classmethod
+    def from_dicts(cls, dicts):
+        """Stack of parameter dictionaries in the format given to ODE, without creating the ODE objects."""
+        self = cls.__new__(cls)
+        self.size = len(dicts)
+        self.state_keys = list(dicts[0]["state_keys"])
+        self.x = np.array([[d[key] for key in self.state_keys] for d in dicts], dtype=float)
+        self.x0 = self.x.copy()
+        self._stack_params(dicts)
+        return self
+
+    def _stack_params(self, dicts):
+        """Sets numeric parameters as arrays with one row per dictionary"""
+        for key, value in dicts[0].items():
+            if key in ("x", "x0", "state_keys") or isinstance(value, (str, dict, bool)):
+                continue
+            try:
+                arr = np.array([d[key] for d in dicts], dtype=float)
+            except (TypeError, ValueError): # not numeric, e.g. module wrappers
+                continue
+            setattr(self, key, arr)
+
+    def get_attr(self, states, attr):
+        """Returns column of state matrix with idx matching given attribute"""
+        return states[..., self.state_keys.index(attr)]
+
+    def reset(self):
+        """Resets states to x0"""
+        self.x[:] = self.x0
+        return
+
+
+def pid_eval(pid, y):
+    """Vectorized PID.eval. Updates every PID in the stack pid and returns the control signals."""
+    I, yprev = pid.x.T
+    dy = (y - yprev)/pid.timestep
+    ek = y - pid.ybar
+
+    P = pid.Kp * ek
+    dI = P/pid.Ti
+    D = pid.Kp * pid.Td * dy
+
+    res = P + I + D
+
+    pid.x[:, 0] = I + dI * pid.timestep # Updates integral term
+    pid.x[:, 1] = y
+    return res
+
+
+class PatientBatch(Stack):
+    """N patients of the same type and model, simulated in lockstep.
+
+    The parameters of the patients may differ (e.g. W, BW, SI or Gbar), but they must
+    share timestep, pancreas_n and pancreas_method. The batch holds copies of the patients' states, so
+    simulating the batch does not change the patients.
+    """
+    def __init__(self, patients):
+        first = patients[0]
+        for p in patients:
+            if (p.type, p.model, p.timestep, p.pancreas_n, p.pancreas_method) != (first.type, first.model, first.timestep, first.pancreas_n, first.pancreas_method):
+                raise ValueError("All patients in a batch must have the same type, model, timestep, pancreas_n and pancreas_method.")
+        super().__init__(patients)
+        self.type = first.type
+        self.model = first.model
+        self.mod = first.mod.mod
+        self.timestep = first.timestep
+        self.pancreas_n = first.pancreas_n
+        self.pancreas_method = first.pancreas_method
+        self.default_penalty = first.default_penalty
+        if self.type != 1:
+            self.pancreasObj = Stack([p.pancreasObj for p in patients])
+        if self.type != 0:
+            self.pumpObj = Stack([p.pumpObj for p in patients])
+
+    def pump(self, G):
+        """Get insulin injection rates from pumps"""
+        if self.type == 0:
+            return np.zeros(self.size)
+        return np.maximum(0, pid_eval(self.pumpObj, G) + self.us)
+
+    def pancreas(self, G):
+        """Get ISRs from pancreases"""
+        if self.type == 1:
+            return np.zeros(self.size)
+        return pancreas.advance(self.pancreasObj, self.pancreasObj.x, G, self.pancreas_n, self.pancreas_method)
+
+    def full_reset(self):
+        """Reset states of patients, pumps and/or pancreases."""
+        self.reset()
+        if self.type != 1:
+            self.pancreasObj.reset()
+        if self.type != 0:
+            self.pumpObj.reset()
+
+    def snapshot(self):
+        """Returns copy of the current states of the patients, pancreases and pumps, as Patient.snapshot."""
+        return Patient.snapshot(self)
+
+    def restore(self, snap):
+        """Sets the states to those of a snapshot. A snapshot of a single Patient gives every patient
+        in the batch its state, e.g. to try a grid of boluses from the same point."""
+        Patient.restore(self, snap)
+
+    def glucose_penalty(self, G, pen_func = None):
+        """Calculates penalties given blood glucose of shape (N, ...)."""
+        if pen_func is None:
+            pen_func = self.default_penalty
+        func, _ = penalty_funcs(pen_func)
+        return func(self, G.T).T # transposed so parameters broadcast along the patient axis
+
+    def time_arr(self, length):
+        return np.linspace(0, length*self.timestep, length)
+
+    def simulate(self, ds = None, uIs = None, uPs = None, iterations = None, out = None, chunk = None):
+        """Simulates all patients in lockstep.
+
+        Takes the same inputs as Patient.simulate. Each of ds, uIs and uPs can be given
+        for all patients (shape (T,)) or per patient (shape (N, T)).
+        If out is given, the result is written to that directory in chunks of chunk iterations
+        (default one day) instead, see store.py.
+
+        Returns
+        -------
+        Info dictionary, where every entry except "t" has one row per patient,
+        or a store.SimulationStore if out is given.
+        """
+        inputs = []
+        for arr in [ds, uIs, uPs]:
+            if arr is not None:
+                arr = np.array(arr, dtype=float, ndmin=1)
+                if arr.ndim == 1:
+                    arr = arr[None, :]
+            inputs.append(arr)
+        ds, uIs, uPs = inputs
+        if iterations is None:
+            iterations = 0
+            for arr in inputs:
+                if arr is not None:
+                    iterations = max(arr.shape[1], iterations)
+            if iterations == 0:
+                iterations = int(24 * 60 / self.timestep)
+        if ds is None:
+            ds = np.zeros((1, 1))
+        if uIs is None:
+            uIs = np.full((1, 1), np.nan)
+        if uPs is None:
+            uPs = np.full((1, 1), np.nan)
+
+        if out is not None:
+            writer = SimulationWriter(out, self, iterations)
+            if chunk is None:
+                chunk = int(24 * 60 / self.timestep)
+            for start in range(0, iterations, chunk):
+                idx = np.arange(start, min(start + chunk, iterations))
+                info = self.simulate(*[arr[:, idx % arr.shape[1]] for arr in (ds, uIs, uPs)], iterations = len(idx))
+                info = {key: value[:, 1:] if key in self.state_keys + ["pens"] else value for key, value in info.items()}
+                writer.write(info) # without initial states
+            return writer.close()
+
+        n = len(self.state_keys)
+        states = np.empty((n, self.size, iterations+1)) # states[i] holds state_keys[i]
+        states[:, :, 0] = self.x.T
+        info = dict(zip(self.state_keys, states))
+        info["t"] = self.time_arr(iterations+1)
+        info["uP"] = np.empty((self.size, iterations))
+        info["uI"] = np.empty((self.size, iterations))
+        info["d"] = np.empty((self.size, iterations))
+        iG = self.state_keys.index("G")
+        iGsc = self.state_keys.index("Gsc")
+        for i in range(iterations):
+            d = ds[:, i%ds.shape[1]]
+            uP = uPs[:, i%uPs.shape[1]]
+            uP = np.where(np.isnan(uP), self.pancreas(self.x[:, iG]), uP)
+            uI = uIs[:, i%uIs.shape[1]]
+            uI = np.where(np.isnan(uI), self.pump(self.x[:, iGsc]), uI)
+            dx = self.mod.sys(self, d = d, uI = uI, uP = uP)
+            self.x += dx * self.timestep
+            self.x[:] = utils.ReLU(self.x)
+            states[:, :, i+1] = self.x.T
+            info["uP"][:, i] = uP
+            info["uI"][:, i] = uI
+            info["d"][:, i] = d
+        info["pens"] = self.glucose_penalty(info["G"])
+        return info
+
+
+def simulate_batch(patients, **kwargs):
+    """Simulates a list of patients in lockstep. See PatientBatch.simulate."""
+    return PatientBatch(patients).simulate(**kwargs)
@@ -0,0 +1,93 @@
+import numpy as np
+import json
+
+
+class BolusTable:
+    """Lookup table of optimal bolus over a grid of meal sizes for one patient.
+
+    The optimal boluses are found once with Patient.best_bolus, and meal sizes in between
+    are answered with a monotone (shape preserving) cubic interpolant.
+
+    Parameters
+    ----------
+    patient : Patient to compute the table for.
+    meal_sizes : grid of meal sizes (grams of carbs). Meals outside the grid can not be looked up.
+    kwargs : passed to best_bolus (e.g. h, n, max_bolus, PID, workers or cache).
+    """
+    def __init__(self, patient, meal_sizes, **kwargs):
+        self.patient = patient
+        self.kwargs = kwargs
+        self.meal_sizes = np.unique(np.asarray(meal_sizes, dtype=float))
+        self.boluses = np.asarray(patient.best_bolus(self.meal_sizes, **kwargs))
+        self._fit()
+        self.error = None
+        self.error_meals = None
+        self.error_exact = None
+
+    def _fit(self):
+        from scipy.interpolate import PchipInterpolator
+        self.interp = PchipInterpolator(self.meal_sizes, self.boluses, extrapolate=False)
+
+    def save(self, path):
+        """Writes the table to a json file: the grid, the boluses, the arguments of best_bolus that can be
+        stored, and the error bound with its probe meal sizes and exact boluses (None if not computed)."""
+        kwargs = {}
+        for key, value in self.kwargs.items():
+            try:
+                json.dumps(value)
+            except TypeError: # e.g. a BolusCache
+                continue
+            kwargs[key] = value
+        data = {
+            "meal_sizes" : self.meal_sizes.tolist(),
+            "boluses" : self.boluses.tolist(),
+            "kwargs" : kwargs,
+            "error" : None if self.error is None else float(self.error),
+            "error_meals" : None if self.error_meals is None else np.asarray(self.error_meals).tolist(),
+            "error_exact" : None if self.error_exact is None else np.asarray(self.error_exact).tolist()
+        }
+        with open(path, "w") as f:
+            json.dump(data, f)
+
+    @classmethod
+    def load(cls, path, patient = None):
+        """Reads a table written by save, without solving best_bolus again.
+        patient is only needed for error_bound."""
+        with open(path, "r") as f:
+            data = json.load(f)
+        table = cls.__new__(cls)
+        table.patient = patient
+        table.kwargs = data["kwargs"]
+        table.meal_sizes = np.array(data["meal_sizes"])
+        table.boluses = np.array(data["boluses"])
+        table._fit()
+        table.error = data["error"]
+        table.error_meals = None if data["error_meals"] is None else np.array(data["error_meals"])
+        table.error_exact = None if data["error_exact"] is None else np.array(data["error_exact"])
+        return table
+
+    def bolus_for(self, meal_size):
+        """Returns interpolated optimal bolus for given meal size(s)."""
+        if np.any(meal_size < self.meal_sizes[0]) or np.any(meal_size > self.meal_sizes[-1]):
+            raise ValueError(f"Meal size outside table range [{self.meal_sizes[0]}, {self.meal_sizes[-1]}].")
+        u = self.interp(meal_size)
+        if u.ndim == 0:
+            return float(u)
+        return u
+
+    def error_bound(self, n = 3):
+        """Estimates the interpolation error by solving best_bolus exactly at n meal sizes.
+        The meal sizes are midpoints between grid points, where the interpolant is furthest from the data.
+
+        Returns
+        -------
+        Largest absolute difference (mU) between interpolated and exact bolus. Also stored as self.error,
+        with the probe meal sizes and exact boluses in self.error_meals and self.error_exact, which save persists.
+        """
+        mids = (self.meal_sizes[:-1] + self.meal_sizes[1:]) / 2
+        idx = np.unique(np.linspace(0, len(mids) - 1, n).round().astype(int))
+        self.error_meals = mids[idx]
+        exact = np.asarray(self.patient.best_bolus(self.error_meals, **self.kwargs))
+        self.error_exact = exact
+        self.error = float(np.max(np.abs(self.bolus_for(self.error_meals) - exact)))
+        return self.error
@@ -0,0 +1,136 @@
+import numpy as np
+import json
+import os
+from contextlib import closing
+
+_source_hashes = {} # hash of the simulator sources by model file, computed once per process
+
+
+def source_hash(model_file):
+    """Returns hash of the model module and every module of the package (simulator, pancreas, PID, penalties),
+    so cached results are invalidated when any of them changes."""
+    if model_file not in _source_hashes:
+        import hashlib
+        package = os.path.dirname(os.path.abspath(__file__))
+        files = sorted(os.path.join(package, name) for name in os.listdir(package) if name.endswith((".py", ".json")))
+        h = hashlib.sha256()
+        for path in [os.path.abspath(model_file)] + files:
+            with open(path, "rb") as f:
+                h.update(f.read())
+        _source_hashes[model_file] = h.hexdigest()
+    return _source_hashes[model_file]
+
+
+def describe(obj):
+    """Returns dictionary of the parameters and initial states of an ODE object that can be stored as json."""
+    params = {}
+    for key, value in obj.__dict__.items():
+        if key == "x" or key.startswith("_"): # current state is reset before every simulation
+            continue
+        if isinstance(value, np.ndarray):
+            value = value.tolist()
+        elif isinstance(value, np.generic):
+            value = value.item()
+        try:
+            json.dumps(value)
+        except TypeError: # module wrappers, pancreas and pump objects
+            continue
+        params[key] = value
+    return params
+
+
+class BolusCache:
+    """On-disk cache for results of Patient.best_bolus and Patient.dense_meal_bolus.
+
+    Entries are stored in an sqlite file and keyed on a hash of the model module source, the
+    parameters of the patient, pancreas and pump, the penalty function, the meal size and the
+    arguments of the call. The model hash also covers the other modules of the package, so
+    results are recomputed after any change to the simulator. When there are more than max_entries entries, the least recently
+    used ones are removed.
+
+    Example
+    -------
+    cache = BolusCache()
+    p.best_bolus([20, 50, 80], cache = cache) # simulates
+    p.best_bolus([20, 50, 80], cache = cache) # reads from cache
+    """
+    def __init__(self, path = None, max_entries = 10000):
+        if path is None:
+            path = os.path.join(os.path.expanduser("~"), ".cache", "diabetessims", "bolus.sqlite")
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        with self._connect() as con:
+            con.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT, used INTEGER)")
+
+    def _connect(self):
+        import sqlite3
+        return closing(sqlite3.connect(self.path))
+
+    def __len__(self):
+        with self._connect() as con:
+            return con.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def key(self, patient, func_name, meal_size, **kwargs):
+        """Returns key of result of patient.func_name(meal_size, **kwargs)."""
+        import hashlib
+        import inspect
+        from diabetessims import extendedmodel
+        model_hash = source_hash(patient.mod.mod.__file__)
+        penalty = getattr(extendedmodel, f"penalty_func{patient.default_penalty}")
+        data = {
+            "func" : func_name,
+            "model" : model_hash,
+            "patient" : describe(patient),
+            "pancreas" : describe(patient.pancreasObj) if patient.type != 1 else None,
+            "pump" : describe(patient.pumpObj) if patient.type != 0 else None,
+            "penalty" : inspect.getsource(penalty),
+            "meal_size" : float(meal_size),
+            "kwargs" : kwargs
+        }
+        return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+    def get(self, key):
+        """Returns cached value, or None if key is not in cache."""
+        with self._connect() as con, con:
+            row = con.execute("SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            con.execute("UPDATE entries SET used = (SELECT MAX(used) FROM entries) + 1 WHERE key = ?", (key,))
+        value = json.loads(row[0])
+        if isinstance(value, list):
+            return np.array(value)
+        return value
+
+    def set(self, key, value):
+        """Stores value and evicts least recently used entries if the cache is full."""
+        value = json.dumps(np.asarray(value, dtype=float).tolist())
+        with self._connect() as con, con:
+            con.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, (SELECT COALESCE(MAX(used), 0) FROM entries) + 1)", (key, value))
+            con.execute("DELETE FROM entries WHERE key NOT IN (SELECT key FROM entries ORDER BY used DESC LIMIT ?)", (self.max_entries,))
+
+    def invalidate(self, key = None):
+        """Removes entry with given key. If key is None, removes all entries."""
+        with self._connect() as con, con:
+            if key is None:
+                con.execute("DELETE FROM entries")
+            else:
+                con.execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def lookup(self, patient, func_name, meal_sizes, compute, **kwargs):
+        """Returns list with one result per meal size, computing only the ones not in cache.
+
+        Parameters
+        ----------
+        compute : function that takes an array of meal sizes and returns their results in order.
+        kwargs : arguments of the call, which are part of the key.
+        """
+        meals = np.array([meal_sizes], dtype=float).flatten()
+        keys = [self.key(patient, func_name, m, **kwargs) for m in meals]
+        results = [self.get(k) for k in keys]
+        missing = [i for i, r in enumerate(results) if r is None]
+        if missing:
+            for i, r in zip(missing, compute(meals[missing])):
+                self.set(keys[i], r)
+                results[i] = r
+        return results
@@ -0,0 +1,285 @@
+import numpy as np
+from . import utils
+from . import pancreas
+from .schedule import as_schedule
+
+MIN_SKIP = 4 # a large step costs about as much as a few euler steps, so shorter ones are not taken
+
+
+def simulate_events(patient, ds, uIs, uPs, iterations, rtol = 1e-4, atol = 1e-6, max_skip = None):
+    """Runs the loop of Patient.simulate, but takes large steps where nothing happens.
+
+    The inputs are turned into Schedules (see schedule.py), so the iterations where a meal, bolus or
+    other input changes are known in advance. Between them the patient is stepped with euler steps
+    exactly as in simulate, and every few steps a large step of m timesteps (at most up to the next
+    input change) is tried. The large step linearizes the patient coupled with its pump and pancreas
+    at the current states, and solves the linearization exactly on the grid of timesteps (see _Coupled),
+    so slow drift, e.g. of the insulin and the PID integral overnight, is integrated instead of stepped.
+    The error of the step is estimated from the nonlinear part of the right hand side at its end, and
+    the step is accepted if the error of the patient states is within atol + rtol*peak (peak is the
+    largest absolute value of the states so far), and is shortened otherwise. The pancreas and pump
+    enter the estimate through their effect on the patient. m grows while large steps are accepted,
+    steps shorter than MIN_SKIP timesteps are not taken, and the number of euler steps between tries
+    grows while they are rejected, so the step size follows the activity.
+    The large steps solve the differential equations rather than repeat euler steps, so they differ
+    from simulate by the error of its euler steps too.
+
+    Parameters
+    ----------
+    ds, uIs, uPs : inputs as in simulate, as arrays or Schedules.
+    iterations : number of iterations.
+    rtol, atol : relative and absolute tolerance of the local error of a large step.
+    max_skip : largest number of timesteps in one large step. Defaults to no limit,
+        and max_skip = 1 gives the same result as simulate.
+
+    Returns
+    -------
+    Info dictionary without penalties, as from simulate. "rhs_evals" is the number of evaluations
+    of the right hand side of the patient, which is iterations for simulate.
+    """
+    schedules = [as_schedule(ds, iterations, 0), as_schedule(uIs, iterations, np.nan), as_schedule(uPs, iterations, np.nan)]
+    breaks = np.unique(np.concatenate([s.breaks for s in schedules])).tolist()
+    if max_skip is None:
+        max_skip = iterations
+    system = _Coupled(patient)
+
+    states = np.empty((len(patient.state_keys), iterations+1)) # row i holds state_keys[i]
+    states[:, 0] = patient.x
+    info = dict(zip(patient.state_keys, states))
+    info["t"] = patient.time_arr(iterations+1)
+    info["uP"] = np.empty(iterations)
+    info["uI"] = np.empty(iterations)
+    info["d"] = np.empty(iterations)
+    evals = 0
+    peak = np.abs(system.state()) # largest values of the coupled states so far
+    m_next = MIN_SKIP # length of the next large step
+
+    for start, stop in zip(breaks[:-1], breaks[1:]):
+        d, uI_arr, uP_arr = [float(s.value_at(start)) for s in schedules]
+        inputs = (d, uI_arr, uP_arr)
+        wait = backoff = 2 # euler steps before the next large step is tried, and after the next rejection
+        f = None # rhs of the coupled system at the current states, if known
+        i = start
+        while i < stop:
+            m = min(stop - i, max_skip, m_next)
+            if wait > 0 or m < 2:
+                # euler step, as in simulate
+                u_panc = patient.pancreas(patient.G)
+                u_pump = patient.pump(patient.Gsc)
+                uP = u_panc if np.isnan(uP_arr) else uP_arr
+                uI = u_pump if np.isnan(uI_arr) else uI_arr
+                dx = patient.f_func(d = d, uI = uI, uP = uP)
+                evals += 1
+                patient.euler_step(dx)
+                patient.update_state(utils.ReLU(patient.x))
+                states[:, i+1] = patient.x
+                info["uP"][i] = uP
+                info["uI"][i] = uI
+                info["d"][i] = d
+                i += 1
+                wait -= 1
+                f = None
+                np.maximum(peak, np.abs(system.state()), out=peak)
+                continue
+
+            # large step over the next m timesteps
+            if f is None:
+                f = system.rhs(*inputs)
+                evals += 1
+            snap = patient.snapshot()
+            z0 = system.state()
+            J = system.jac(*inputs)
+            grid = system.grid(z0, f, J, m)
+            tol = atol + rtol * peak
+            while True:
+                x, uI, uP = system.take(grid[:, :m+1], uI_arr, uP_arr)
+                f_end = system.rhs(*inputs)
+                evals += 1
+                # the nonlinear part grows about linearly over the step, and the error it causes is about
+                # H phi2(H J) nonlinear, which is estimated with phi2(z) ~ 1/(2 - 2z/3), so stiff states are not
+                # held to the H/2 of the slow ones
+                H = m * patient.timestep
+                nonlinear = f_end - f - J @ (system.state() - z0)
+                err = (np.abs(np.linalg.solve(np.eye(len(J)) - H/3 * J, H/2 * nonlinear)) / tol)[:len(patient.x)].max()
+                if err <= 1:
+                    break
+                m = min(m // 2, int(m * 0.9 / np.sqrt(err)))
+                if m < MIN_SKIP: # too much activity, continue with euler steps
+                    break
+                patient.restore(snap)
+            if err > 1:
+                patient.restore(snap)
+                wait, backoff = backoff, min(2 * backoff, 64)
+                m_next = MIN_SKIP
+                continue
+            states[:, i+1:i+m+1] = x[:, 1:]
+            info["uI"][i:i+m] = uI[:m]
+            info["uP"][i:i+m] = uP[:m]
+            info["d"][i:i+m] = d
+            np.maximum(peak, np.abs(system.state()), out=peak)
+            f = f_end
+            m_next = int(m * min(2, 0.9 / np.sqrt(max(err, 1e-12))))
+            if m_next < MIN_SKIP: # activity picks up, continue with euler steps
+                wait, m_next = backoff, MIN_SKIP
+            else:
+                backoff = 2
+            i += m
+    info["rhs_evals"] = evals
+    return info
+
+
+class _Coupled:
+    """The patient coupled with its pump and pancreas, as one system for the large steps of simulate_events.
+
+    The states are those of the patient, the PID integral (if there is a pump) and those of the
+    pancreas (if there is one). The pump and pancreas are not evaluated, but their outputs are
+    computed from the states as the next euler step of simulate would: uI from Gsc, the PID
+    integral and the previous Gsc, and uP as the ISR of the pancreas states. In the Jacobian
+    the derivative term of the PID is differentiated as Kp*Td*dGsc/dt.
+    """
+
+    def __init__(self, patient):
+        self.patient = patient
+        self.pk = patient.pancreasObj if patient.type != 1 else None
+        self.pid = patient.pumpObj if patient.type != 0 else None
+        n = len(patient.x)
+        self.iG, self.iGsc = patient._idx["G"], patient._idx["Gsc"]
+        self.iI = n if self.pid is not None else None
+        start = n + (self.pid is not None)
+        self.ipk = slice(start, start + 7) if self.pk is not None else None
+        self.size = start + 7 * (self.pk is not None)
+
+    def state(self):
+        z = [self.patient.x]
+        if self.pid is not None:
+            z.append(self.pid.x[:1])
+        if self.pk is not None:
+            z.append(self.pk.x)
+        return np.concatenate(z)
+
+    def outputs(self, x, pid_x, pk_x, uI_arr, uP_arr):
+        """Returns uI and uP for patient states x (shape (n, k)), the PID states (integral and previous Gsc)
+        before each of the k timesteps and pancreas states pk_x (shape (7, k))"""
+        p = self.patient
+        k = x.shape[1]
+        uI = np.full(k, uI_arr)
+        if self.pid is not None and np.isnan(uI_arr):
+            pid = self.pid
+            Gsc = x[self.iGsc]
+            I, yprev = pid_x
+            uI = np.maximum(0, pid.Kp * (Gsc - pid.ybar) + I + pid.Kp * pid.Td * (Gsc - yprev)/pid.timestep + p.us)
+        elif np.isnan(uI_arr):
+            uI[:] = 0
+        uP = np.full(k, uP_arr)
+        if self.pk is not None and np.isnan(uP_arr):
+            pk = self.pk
+            G = x[self.iG]
+            uP = pk.W * np.maximum(pk.I0 * pk_x[6] * pk_x[5] * pancreas.secretion_factor(pk, G) * pk.N, 0) # rho and DIR
+        elif np.isnan(uP_arr):
+            uP[:] = 0
+        return uI, uP
+
+    def _current_outputs(self, uI_arr, uP_arr):
+        """outputs for the current states, with plain floats"""
+        p = self.patient
+        uI = uI_arr
+        if np.isnan(uI_arr):
+            uI = 0
+            if self.pid is not None:
+                pid = self.pid
+                I, yprev = pid.x
+                uI = max(0, pid.Kp * (p.Gsc - pid.ybar) + I + pid.Kp * pid.Td * (p.Gsc - yprev)/pid.timestep + p.us)
+        uP = uP_arr
+        if np.isnan(uP_arr):
+            uP = self.pk.get_ISR(p.G) if self.pk is not None else 0
+        return uI, uP
+
+    def rhs(self, d, uI_arr, uP_arr):
+        """Right hand side of the coupled system at the current states"""
+        p = self.patient
+        self.u = uI, uP = self._current_outputs(uI_arr, uP_arr)
+        f = np.empty(self.size)
+        f[:len(p.x)] = p.f_func(d = d, uI = uI, uP = uP)
+        if self.pid is not None:
+            f[self.iI] = self.pid.Kp * (p.Gsc - self.pid.ybar) / self.pid.Ti
+        if self.pk is not None:
+            f[self.ipk] = self.pk.sys(p.G)[0]
+        return f
+
+    def jac(self, d, uI_arr, uP_arr):
+        """Jacobian of rhs with respect to the states of the coupled system, at the states of the last call of rhs"""
+        p = self.patient
+        n = len(p.x)
+        uI, uP = self.u
+        Jx = p.jac(d = d, uI = uI, uP = uP)
+        B = p.input_jac(d = d, uI = uI, uP = uP)
+        J = np.zeros((self.size, self.size))
+        J[:n, :n] = Jx
+        if self.pid is not None:
+            pid = self.pid
+            J[self.iI, self.iGsc] = pid.Kp / pid.Ti
+            if np.isnan(uI_arr) and uI > 0: # not cut off at zero
+                duI = np.zeros(self.size)
+                duI[:n] = pid.Kp * pid.Td * Jx[self.iGsc]
+                duI[self.iGsc] += pid.Kp
+                duI[self.iI] = 1
+                J[:n] += np.outer(B[:, 1], duI)
+        if self.pk is not None:
+            pk = self.pk
+            J[self.ipk, self.ipk] = pk.jac(p.G)
+            J[self.ipk, self.iG] = pk.input_jac(p.G)
+            if np.isnan(uP_arr):
+                dISR, dISR_G = pk.ISR_jac(p.G)
+                duP = np.zeros(self.size)
+                duP[self.ipk] = dISR
+                duP[self.iG] += dISR_G
+                J[:n] += np.outer(B[:, 2], duP)
+        return J
+
+    def grid(self, z0, f, J, m):
+        """Solution of the linearization dz = f + J (z - z0) after 0, 1, ..., m timesteps, of shape (size, m+1).
+
+        With one timestep h, z(t + h) - z0 = exp(h J) (z(t) - z0) + h phi1(h J) f, which is the
+        exponential of [[h J, h f], [0, 0]] applied to (z(t) - z0, 1). The states are scaled by
+        their size if that makes J smaller, as the entries of J can range over several orders of magnitude.
+        """
+        h = self.patient.timestep
+        scale = np.abs(z0) + np.abs(f) * h
+        scale = np.maximum(scale, 1e-8 * scale.max() + 1e-300)
+        scaled = J * scale[None, :] / scale[:, None]
+        if np.abs(scaled).sum(axis=1).max() > np.abs(J).sum(axis=1).max():
+            scale, scaled = np.ones(self.size), J
+        A = np.zeros((self.size + 1, self.size + 1))
+        A[:-1, :-1] = scaled * h
+        A[:-1, -1] = f * h / scale
+        E = utils.expm(A)
+        out = np.empty((self.size, m + 1))
+        w = np.zeros(self.size + 1)
+        w[-1] = 1
+        for k in range(m + 1):
+            out[:, k] = w[:-1]
+            w = E @ w
+        return z0[:, None] + scale[:, None] * out
+
+    def take(self, grid, uI_arr, uP_arr):
+        """Moves the states to the end of grid (from grid), and returns the patient states on the grid
+        and the inputs uI and uP of its timesteps. The PID integral and previous Gsc are updated
+        with the Gsc of the grid, as in simulate."""
+        p = self.patient
+        n = len(p.x)
+        m = grid.shape[1] - 1
+        x = utils.ReLU(grid[:n])
+        pid_x = pk_x = None
+        if self.pid is not None:
+            pid = self.pid
+            Gsc = x[self.iGsc]
+            I = pid.x[0] + np.concatenate(([0], np.cumsum(pid.Kp * (Gsc[:-1] - pid.ybar) / pid.Ti * pid.timestep)))
+            yprev = np.concatenate(([pid.x[1]], Gsc[:-1]))
+            pid_x = (I, yprev)
+            pid.x[:] = I[-1], yprev[-1]
+        if self.pk is not None:
+            pk_x = utils.ReLU(grid[self.ipk])
+            self.pk.x[:] = pk_x[:, -1]
+        uI, uP = self.outputs(x, pid_x, pk_x, uI_arr, uP_arr)
+        p.update_state(x[:, -1])
+        return x, uI, uP
@@ -1,11 +1,18 @@
 import numpy as np
-import json
-import matplotlib.pyplot as plt
-from scipy.integrate import simpson
+import importlib
+import itertools
+from collections.abc import Iterator
 from diabetessims.odeclass import ODE
 import diabetessims.pancreas as pancreas
-from scipy.optimize import root_scalar, minimize_scalar, minimize
 import diabetessims.utils as utils
+import diabetessims.parameters as parameters
+import diabetessims.sensitivity as sensitivity
+import diabetessims.store as store
+import diabetessims.metrics as metrics
+from diabetessims.bolustable import BolusTable
+from diabetessims.schedule import Schedule
+# matplotlib, scipy, numba (kernel) and the process pool are imported in the functions
+# that use them, so "import diabetessims" stays fast.
 
 def penalty_func1(p, G):
     return  1/2 * (18*(G - p.Gbar))**2 + p.kappa/2 * utils.ReLU(18*(p.Gmin - G))**2
@@ -13,6 +20,22 @@ def penalty_func1(p, G):
 def penalty_func2(p, G):
     return 1/2 * utils.ReLU(18*((p.Gbar - 1) - G))**2 + 1/2 * utils.ReLU((G - (p.Gbar + 1))*18)**2 + p.kappa/2 * utils.ReLU((p.Gmin - G)*18)**2
 
+def penalty_deriv1(p, G):
+    """Derivative of penalty_func1 with respect to G"""
+    return 18**2 * (G - p.Gbar) - 18 * p.kappa * utils.ReLU(18*(p.Gmin - G))
+
+def penalty_deriv2(p, G):
+    """Derivative of penalty_func2 with respect to G"""
+    return -18 * utils.ReLU(18*((p.Gbar - 1) - G)) + 18 * utils.ReLU((G - (p.Gbar + 1))*18) - 18 * p.kappa * utils.ReLU((p.Gmin - G)*18)
+
+def penalty_funcs(pen_func):
+    """Returns penalty function pen_func (1 or 2) and its derivative."""
+    if pen_func == 1:
+        return penalty_func1, penalty_deriv1
+    if pen_func == 2:
+        return penalty_func2, penalty_deriv2
+    raise ValueError(f"Unknown penalty function {pen_func!r}, use 1 or 2.")
+
 
 class Patient(ODE):
     def __init__(self, patient_type, model, **kwargs):
@@ -20,10 +43,9 @@ class Patient(ODE):
         self.type = patient_type
 
         defaults = {} #tomt dictionary 
-        with open('diabetessims/config.json', 'r') as f:
-            data = json.load(f) #læs json-fil
-        defaults.update(data["general"]) #tilføj "general" til dictionary(defaults)
-        defaults.update(self.mod.params)
+        defaults.update(parameters.get("general")) #tilføj "general" til dictionary(defaults)
+        defaults.update(model.params)
+        defaults["model"] = model.name
         defaults.update(kwargs) #tilføj keywordarguments til dictionary(defaults)
 
         super().__init__(defaults)
@@ -36,6 +58,16 @@ class Patient(ODE):
 
         self.default_penalty = 1
 
+    def __getstate__(self):
+        """Modules can not be pickled, so only the name of the model module is stored."""
+        state = self.__dict__.copy()
+        state["mod"] = self.mod.mod.__name__
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__dict__["mod"] = utils.Wrapper(importlib.import_module(state["mod"]), self)
+
     def pump(self, G = None):
         """Get insulin injection rate from pump"""
         if self.type == 0:
@@ -48,10 +80,7 @@ class Patient(ODE):
         """Get ISR from pancreas"""
         if self.type == 1:
             return 0
-        u = 0
-        for i in range(self.pancreas_n):
-            u += self.pancreasObj.eval(G)
-        return max(0, u/self.pancreas_n)
+        return pancreas.advance(self.pancreasObj, self.pancreasObj.x, G, self.pancreas_n, self.pancreas_method)
 
         
     def full_reset(self):
@@ -62,10 +91,33 @@ class Patient(ODE):
         if self.type != 0:
             self.pumpObj.reset()
 
+    def snapshot(self):
+        """Returns copy of the current states of the patient, pancreas and pump (PID integral and yprev).
+
+        The snapshot is a dictionary of arrays, so it can be pickled or stored, and restore returns
+        the patient to it. E.g. simulate 12 days, take a snapshot, and try several boluses from there.
+        Between the chunks of simulate_iter, the states are those at the end of the last chunk.
+        """
+        snap = {"patient" : self.x.copy()}
+        if self.type != 1:
+            snap["pancreas"] = self.pancreasObj.x.copy()
+        if self.type != 0:
+            snap["pump"] = self.pumpObj.x.copy()
+        return snap
+
+    def restore(self, snap):
+        """Sets the states of the patient, pancreas and pump to those of a snapshot."""
+        self.x[:] = snap["patient"]
+        if self.type != 1:
+            self.pancreasObj.x[:] = snap["pancreas"]
+        if self.type != 0:
+            self.pumpObj.x[:] = snap["pump"]
+
     def steadystate(self, G = None, uI = None, uP = 0):
         """Return steady state vector and insulin injection rate to maintain it.
         Can be calculated from either G or uI.
         If G and uI are both None, determines steady state where G is Gbar.
+        G and uI can be arrays, in which case the states are stacked along the last axis.
         """
         return self.mod.steadystate(G = G, uI = uI, uP=uP)
 
@@ -96,6 +148,14 @@ class Patient(ODE):
         """
         return self.mod.sys(d = d, uI = uI, uP = uP)
     
+    def jac(self, d = 0, uI = 0, uP = 0):
+        """Returns Jacobian of f_func with respect to the state."""
+        return self.mod.jac(d = d, uI = uI, uP = uP)
+
+    def input_jac(self, d = 0, uI = 0, uP = 0):
+        """Returns Jacobian of f_func with respect to the inputs (columns d, uI and uP)."""
+        return self.mod.input_jac(d = d, uI = uI, uP = uP)
+
     def G_from_u(self, u):
         """Returns G of steady state with given insulin rate (uI + uP)"""
         return self.mod.G_from_u(u)
@@ -116,13 +176,43 @@ class Patient(ODE):
             G = self.G
         if pen_func is None:
             pen_func = self.default_penalty
-        if pen_func == 1:
-            func = lambda g: penalty_func1(self, g)
-        if pen_func == 2:
-            func = lambda g: penalty_func2(self, g)
-        return func(G)
+        func, _ = penalty_funcs(pen_func)
+        return func(self, G)
  
-    def simulate(self, ds = None, uIs = None, uPs = None, iterations = None):
+    def input_iterations(self, ds = None, uIs = None, uPs = None):
+        """Returns default number of iterations of simulate: length of longest input, or 24h."""
+        iterations = 0
+        for arr in [ds, uIs, uPs]:
+            if arr is not None:
+                iterations = max(len(arr), iterations)
+        if iterations == 0:
+            iterations = int(24 * 60 / self.timestep)
+        return iterations
+
+    def prepare_inputs(self, ds = None, uIs = None, uPs = None, iterations = None):
+        """Returns input arrays and number of iterations as used by simulate."""
+        ds, uIs, uPs = [np.asarray(arr) if isinstance(arr, Schedule) else arr for arr in (ds, uIs, uPs)]
+        if iterations is None:
+            iterations = self.input_iterations(ds, uIs, uPs)
+        if ds is None: # if no meal is given, set to zero.
+            ds = np.zeros(iterations)
+        else:
+            ds = np.array([ds]).flatten()
+
+        uPs = np.array([uPs]).flatten()
+        uIs = np.array([uIs]).flatten()
+        return ds, uIs, uPs, iterations
+
+    def glucose_penalty_deriv(self, G = None, pen_func = None):
+        """Calculates derivative of penalty with respect to blood glucose."""
+        if G is None: # If G is not specified, use current G
+            G = self.G
+        if pen_func is None:
+            pen_func = self.default_penalty
+        _, deriv = penalty_funcs(pen_func)
+        return deriv(self, G)
+
+    def simulate(self, ds = None, uIs = None, uPs = None, iterations = None, engine = "python", integrator = "euler", ivp_options = None, out = None, chunk = None):
         """Simulates patient.
 
         Parameters
@@ -131,6 +221,24 @@ class Patient(ODE):
         uIs : Insulin injection rate. Defaults to None.
         uPs : Insulin secretion rate. Defaults to None.
         iterations : Number of iterations. Defaults to length of longest array in {ds, uIs, uPs}, or a number such that the simulation is 24h long.
+        engine : "python" runs the simulation step by step through the model modules.
+            "fast" runs the whole simulation in one compiled kernel (see kernel.py), which gives the same result.
+        integrator : "euler" uses fixed explicit euler steps, and pancreas_n substeps for the pancreas
+            with pancreas_method ("euler", or "exponential" which is stable with pancreas_n = 1).
+            Otherwise the name of a scipy.integrate.solve_ivp method, e.g. "RK45" or "BDF",
+            to integrate with error control between the timesteps (see integrators.py). engine is then ignored.
+            While the PID pump is in use every timestep is a separate integration, so they only take
+            steps longer than a timestep for patient_type 0 or when uIs is given.
+            "events" uses euler steps around input changes and PID/pancreas activity, and large
+            exponential steps where the patient changes slowly (see events.py). Best used with Schedules as inputs.
+        ivp_options : dictionary of options for solve_ivp, e.g. rtol and atol.
+            With integrator "events", options of events.simulate_events, e.g. rtol, atol and max_skip.
+        out : directory to write the result to (see store.py). The simulation is then run in chunks
+            with simulate_iter and written to memory-mapped files, so it is never held in memory.
+        chunk : number of iterations per chunk when out is given. Defaults to one day.
+
+        The inputs can also be Schedules (see schedule.py). Except with integrator "events", they are
+        expanded into arrays with one value per iteration first.
 
         The arrays, ds, uIs and uPs, are looped through. In iteration i, the value arr[i%len(arr)] is used. 
         They can be passed as numbers, where they will be treated as one element arrays.
@@ -139,25 +247,35 @@ class Patient(ODE):
         
         Returns
         -------
-        Info dictionary.
+        Info dictionary, or a store.SimulationStore if out is given.
         """
-        if iterations is None:
-            iterations = 0
-            for arr in [ds, uIs, uPs]:
-                if arr is not None:
-                    iterations = max(len(arr), iterations)
-            if iterations == 0:
-                iterations = int(24 * 60 / self.timestep)
-        if ds is None: # if no meal is given, set to zero.
-            ds = np.zeros(iterations)
-            dn = iterations
-        else:
-            ds = np.array([ds]).flatten()
-            dn = len(ds)
-
-
-        uPs = np.array([uPs]).flatten()
-        uIs = np.array([uIs]).flatten()
+        if integrator == "events" and out is None: # uses the inputs as Schedules, without making arrays
+            from diabetessims import events
+            if iterations is None:
+                iterations = self.input_iterations(ds, uIs, uPs)
+            info = events.simulate_events(self, ds, uIs, uPs, iterations, **(ivp_options or {}))
+            info["pens"]=self.glucose_penalty(info["G"])
+            return info
+
+        ds, uIs, uPs, iterations = self.prepare_inputs(ds, uIs, uPs, iterations)
+        dn = len(ds)
+
+        if out is not None:
+            writer = store.SimulationWriter(out, self, iterations)
+            for info in self.simulate_iter(ds, uIs, uPs, iterations = iterations, chunk = chunk, engine = engine, integrator = integrator, ivp_options = ivp_options):
+                writer.write(info)
+            return writer.close()
+
+        if integrator != "euler":
+            from diabetessims import integrators
+            info = integrators.simulate_ivp(self, ds, uIs, uPs, iterations, method = integrator, **(ivp_options or {}))
+            info["pens"]=self.glucose_penalty(info["G"])
+            return info
+        if engine == "fast":
+            from diabetessims import kernel
+            info = kernel.simulate(self, ds, uIs, uPs, iterations)
+            info["pens"]=self.glucose_penalty(info["G"])
+            return info
 
         def uP_func(i):
             u_panc = self.pancreas(self.G)
@@ -177,35 +295,84 @@ class Patient(ODE):
                 return u_pump
             return u_arr
 
-        info = dict()
-        for i in self.state_keys:
-            info[i]=np.empty(iterations+1)
-            info[i][0]=getattr(self,i)
+        states = np.empty((len(self.state_keys), iterations+1)) # row i holds state_keys[i]
+        states[:, 0] = self.x
+        info = dict(zip(self.state_keys, states))
         info["t"] = self.time_arr(iterations+1)
-        info["uP"] = []
-        info["uI"] = []
-        info["d"] = []
+        info["uP"] = np.empty(iterations)
+        info["uI"] = np.empty(iterations)
+        info["d"] = np.empty(iterations)
         for i in range(iterations):
             d = ds[i%dn]
             uP = uP_func(i)
             uI = uI_func(i)
             dx = self.f_func(d = d, uI = uI, uP = uP)
             self.euler_step(dx)
-            x = utils.ReLU(self.get_state())     
-            self.update_state(x)
-            for k in self.state_keys:
-                info[k][i+1]=getattr(self,k)
-            info["uP"].append(uP)
-            info["uI"].append(uI)
-            info["d"].append(d)
-        info["uI"] = np.array(info["uI"])
-        info["uP"] = np.array(info["uP"])
-        info["d"] = np.array(info["d"])
+            self.update_state(utils.ReLU(self.x))
+            states[:, i+1] = self.x
+            info["uP"][i] = uP
+            info["uI"][i] = uI
+            info["d"][i] = d
         info["pens"]=self.glucose_penalty(info["G"])
         return info
 
-    def bolus_sim(self, bolus, meal_size, meal_idx = 0, h = 24, plot = False, PID = False):
+    def simulate_iter(self, ds = None, uIs = None, uPs = None, iterations = None, chunk = None, **kwargs):
+        """Simulates patient in chunks, and yields the result of each chunk as soon as it is done.
+
+        Only one chunk is held in memory at a time, so the horizon can be arbitrarily long.
+
+        Parameters
+        ----------
+        ds, uIs, uPs : Inputs as in simulate. Arrays are looped through, while iterators
+            (e.g. generators) are consumed one value per iteration. None values mean pump/pancreas.
+        iterations : Total number of iterations. Defaults to running until an input iterator is exhausted,
+            or forever if all inputs are arrays.
+        chunk : Number of iterations per chunk. Defaults to one day.
+        kwargs : passed to simulate, e.g. engine or integrator.
+
+        Returns
+        -------
+        Generator of info dictionaries, one per chunk. Unlike simulate, the initial state is not included,
+        so entry k of every key belongs to iteration k of the chunk, and "t" holds the absolute time
+        of the states (minutes since the start of the stream). When iterations is given, "t" is the
+        time_arr of simulate, so the chunks joined with the initial time 0 equal simulate(...)["t"].
+        Without iterations that time base is not known in advance, and "t" is the number of timesteps times timestep.
+        See metrics.StreamSummary for aggregating the chunks.
+        """
+        if chunk is None:
+            chunk = int(24 * 60 / self.timestep)
+        # spacing of time_arr(iterations + 1), which is stretched to end at (iterations + 1) * timestep
+        dt = self.timestep if not iterations else (iterations + 1) * self.timestep / iterations
+        streams = [_input_stream(ds, 0), _input_stream(uIs, np.nan), _input_stream(uPs, np.nan)]
+        done = 0
+        while iterations is None or done < iterations:
+            n = chunk if iterations is None else min(chunk, iterations - done)
+            inputs = [np.array(list(itertools.islice(s, n)), dtype=float) for s in streams]
+            n = min(len(arr) for arr in inputs)
+            if n == 0:
+                return
+            info = self.simulate(*[arr[:n] for arr in inputs], iterations = n, **kwargs)
+            for key in self.state_keys + ["pens"]:
+                info[key] = info[key][1:]
+            info["t"] = (done + np.arange(1, n + 1)) * dt
+            done += n
+            if done == iterations: # as np.linspace, which sets the last time exactly
+                info["t"][-1] = (iterations + 1) * self.timestep
+            yield info
+
+    def bolus_sim(self, bolus, meal_size, meal_idx = 0, h = 24, plot = False, PID = False, response = None):
+        """Simulates meal and bolus from the initial state, and returns the integrated penalty, the penalty and G.
+        If a response from bolus_response (for the same meal_size, meal_idx and h) is given, only G is simulated,
+        and the state of the patient is not changed. A response for another meal raises ValueError."""
         iterations = int(h * 60 / self.timestep)
+        if response is not None and (response["meal_size"], response["meal_idx"], response["h"]) != (meal_size, meal_idx, h):
+            raise ValueError(f"Response is for meal_size = {response['meal_size']}, meal_idx = {response['meal_idx']} and h = {response['h']}, "
+                             f"not for meal_size = {meal_size}, meal_idx = {meal_idx} and h = {h}.")
+        if response is not None and not PID and bolus >= 0:
+            phi, p, Gt = self.bolus_penalty(bolus, response)
+            if plot:
+                self._plot_bolus(self.time_arr(iterations + 1)/60, p, Gt)
+            return phi, p, Gt
         ds = np.zeros(iterations)
         if PID:
             us = np.empty(iterations)
@@ -219,21 +386,59 @@ class Patient(ODE):
         Gt = info["G"]
         p = self.glucose_penalty(Gt)
         t = self.time_arr(iterations + 1)/60
+        from scipy.integrate import simpson
         phi = simpson(p, x = t)
         if plot:
-            fig, ax = plt.subplots(1,2)
-            ax[0].plot(t, p)
-            ax[1].plot(t, Gt)
-            ax[0].set_xlabel("time(h)")
-            ax[1].set_xlabel("time(h)")
-            ax[1].set_ylabel("g")
-
-            ax[0].set_title("Penalty Function")
-            ax[1].set_title("Blood Glucose")
-            plt.show()
+            self._plot_bolus(t, p, Gt)
         return phi, p, Gt
+
+    def _plot_bolus(self, t, p, Gt):
+        """Plots penalty and G of bolus_sim against time t in hours."""
+        import matplotlib.pyplot as plt
+        fig, ax = plt.subplots(1,2)
+        ax[0].plot(t, p)
+        ax[1].plot(t, Gt)
+        ax[0].set_xlabel("time(h)")
+        ax[1].set_xlabel("time(h)")
+        ax[1].set_ylabel("g")
+
+        ax[0].set_title("Penalty Function")
+        ax[1].set_title("Blood Glucose")
+        plt.show()
     
-    def best_bolus(self, meal_size, min_bolus = 0, max_bolus = 15000, n = 10,  h = 24, PID = False):
+    def bolus_response(self, meal_size, meal_idx = 0, h = 24):
+        """Returns the parts of bolus_sim (without PID) that are the same for every bolus, or None if
+        the model has no such split (only MVP patients without pancreas have).
+
+        The meal absorption (D1, D2) does not depend on the bolus, and the insulin states are affine in it,
+        so Ieff for bolus u is Ieff of the basal rate plus u times Ieff of a unit bolus. With the response,
+        bolus_penalty only has to simulate G. In HM the insulin action depends on G, so only the meal
+        absorption could be reused, which is a negligible part of a step, and None is returned.
+        """
+        if self.type != 1 or not hasattr(self.mod.mod, "meal_insulin_response"):
+            return None
+        iterations = int(h * 60 / self.timestep)
+        ds = np.zeros(iterations)
+        ds[meal_idx] = meal_size / self.timestep
+        us = np.ones(iterations) * self.us
+        D2, Ieff = self.mod.meal_insulin_response(ds, us, self.x0)
+        impulse = np.zeros(iterations)
+        impulse[0] = 1 / self.timestep
+        _, unit = self.mod.meal_insulin_response(np.zeros(iterations), impulse, np.zeros(len(self.x0)))
+        return {"meal_size" : meal_size, "meal_idx" : meal_idx, "h" : h, "D2" : D2, "Ieff" : Ieff, "unit" : unit}
+
+    def bolus_penalty(self, bolus, response):
+        """Returns integrated penalty, penalty and G of bolus_sim for non-negative bolus(es), using a bolus_response.
+        All boluses are simulated at once, so with an array of m boluses the results have m rows."""
+        bolus = np.asarray(bolus, dtype=float)
+        Ieff = response["Ieff"] + bolus[..., None] * response["unit"]
+        Gt = self.mod.G_response(response["D2"], Ieff, self.G0)
+        p = self.glucose_penalty(Gt)
+        t = self.time_arr(Gt.shape[-1])/60
+        from scipy.integrate import simpson
+        return simpson(p, x = t, axis = -1), p, Gt
+
+    def best_bolus(self, meal_size, min_bolus = 0, max_bolus = 15000, n = 10,  h = 24, PID = False, workers = 1, cache = None, surrogate = None):
         """Finds optimal bolus given meal size.
         First checks penalty at a few boluses size in a wide range, and selects the one with the minimum penalty.
         Then searches for minimum around that point.
@@ -245,25 +450,104 @@ class Patient(ODE):
         max_bolus : maximum dose to include in initial check.
         n : number of points to check in initial check (Will check np.linspace(min_bolus, max_bolus, n)).
         h : number of hours to run simulation for
+        workers : number of processes to use. If larger than 1, the simulations are run in a process pool on copies of the patient.
+            When a bolus_response is used (see below), the boluses of one meal are evaluated at once
+            and workers only splits several meals between processes.
+        cache : BolusCache to read results from and store new results in.
+        surrogate : BolusSurrogate to search with instead, so only a few candidates are simulated (see surrogate.py).
+            min_bolus and max_bolus limit its search, h and PID must be those of the surrogate,
+            and n and workers are not used. It can not be combined with cache.
+
+        Without PID, patients that have a bolus_response (MVP without pancreas) only simulate G for each bolus,
+        as the insulin states are affine in the bolus. The penalties agree with full simulations to rounding,
+        but the search can then stop at a slightly different bolus within its tolerance.
         """
+        if surrogate is not None:
+            if (h, PID) != (surrogate.h, surrogate.PID):
+                raise ValueError(f"The surrogate is for h = {surrogate.h} and PID = {surrogate.PID}, not h = {h} and PID = {PID}.")
+            if cache is not None:
+                raise ValueError("cache can not be used with a surrogate.")
+            return surrogate.best_bolus(meal_size, min_bolus = min_bolus, max_bolus = max_bolus)
+        if cache is not None:
+            compute = lambda meals: self.best_bolus(meals, min_bolus = min_bolus, max_bolus = max_bolus, n = n, h = h, PID = PID, workers = workers)
+            res = cache.lookup(self, "best_bolus", meal_size, compute, min_bolus = min_bolus, max_bolus = max_bolus, n = n, h = h, PID = PID)
+            if isinstance(meal_size, (np.ndarray, list, tuple)):
+                return np.array(res)
+            return res[0]
         if isinstance(meal_size, (np.ndarray, list, tuple)):
+            if workers > 1: # one meal per task
+                args = [(m, min_bolus, max_bolus, n, h, PID) for m in meal_size]
+                return np.array(parallel_map(self, _best_bolus_task, args, workers))
             return np.array([self.best_bolus(meal_size=m, min_bolus = min_bolus, max_bolus = max_bolus, n = n, h = h, PID = PID) for m in meal_size])
         # broad and rough search for minima
         us = np.linspace(min_bolus, max_bolus, n)
-        phis = []
-        for u in us:
-            phi, _, _ = self.bolus_sim(u, meal_size = meal_size, h = h, PID = PID)
-            phis.append(phi)
+        response = None if PID else self.bolus_response(meal_size, h = h) # shared by all boluses of the meal
+        if response is not None and min_bolus >= 0:
+            phis = self.bolus_penalty(us, response)[0]
+        elif workers > 1:
+            phis = parallel_map(self, _bolus_sim_task, [(u, meal_size, h, PID) for u in us], workers)
+        else:
+            phis = []
+            for u in us:
+                phi, _, _ = self.bolus_sim(u, meal_size = meal_size, h = h, PID = PID)
+                phis.append(phi)
         # choose u0 where 
         u0 = us[np.argmin(phis)]
         def cost(u):
-            phi, _, _ = self.bolus_sim(u, meal_size = meal_size, h = h)
+            phi, _, _ = self.bolus_sim(u, meal_size = meal_size, h = h, response = response)
             return phi
+        from scipy.optimize import minimize_scalar
         return minimize_scalar(cost, bounds=[u0 - (max_bolus-min_bolus)/n, u0 + (max_bolus-min_bolus)/n]).x
 
 
-    def dense_meal_bolus(self, meal_size = 0, min_bolus = 0, max_bolus = 15000, n = 50, h = 24, PID = False):
+    def bolus_grid(self, meal_size, boluses, h = 24, PID = False):
+        """Returns the penalty of bolus_sim for every bolus in boluses.
+        All boluses for a meal are simulated at once as a PatientBatch of copies of the patient,
+        so the bolus axis is a vector dimension in the model equations.
+        If several meal sizes are given, returns array of shape (len(meal_size), len(boluses)).
+        """
+        from diabetessims.batch import PatientBatch
+        if isinstance(meal_size, (np.ndarray, list, tuple)):
+            return np.array([self.bolus_grid(m, boluses, h = h, PID = PID) for m in meal_size])
+        boluses = np.asarray(boluses, dtype=float)
+        iterations = int(h * 60 / self.timestep)
+        ds = np.zeros(iterations)
+        ds[0] = meal_size / self.timestep # Ingestion
+        if PID:
+            us = np.empty((len(boluses), iterations))
+            us[:] = np.nan
+        else:
+            us = np.ones((len(boluses), iterations)) * self.us
+        us[:, 0] = boluses / self.timestep + self.us
+        batch = PatientBatch([self] * len(boluses))
+        batch.full_reset()
+        info = batch.simulate(ds = ds, uIs = us)
+        t = self.time_arr(iterations + 1)/60
+        from scipy.integrate import simpson
+        return simpson(info["pens"], x = t, axis = -1)
+
+    def dense_meal_bolus(self, meal_size = 0, min_bolus = 0, max_bolus = 15000, n = 50, h = 24, PID = False, workers = 1, vectorized = False, cache = None):
+        """Returns penalty of every bolus in np.linspace(min_bolus, max_bolus, n) for given meal size(s), and the boluses.
+        If workers is larger than 1, the grid cells are evaluated in a process pool on copies of the patient.
+        If vectorized is True, all boluses for a meal are simulated at once with bolus_grid.
+        If a BolusCache is given as cache, results are read from and stored in it.
+        """
         us = np.linspace(min_bolus, max_bolus, n)
+        if cache is not None:
+            compute = lambda meals: self.dense_meal_bolus(meals, min_bolus = min_bolus, max_bolus = max_bolus, n = n, h = h, PID = PID, workers = workers, vectorized = vectorized)[0]
+            res = cache.lookup(self, "dense_meal_bolus", meal_size, compute, min_bolus = min_bolus, max_bolus = max_bolus, n = n, h = h, PID = PID)
+            if isinstance(meal_size, (np.ndarray, list, tuple)):
+                return np.array(res), us
+            return res[0], us
+        if vectorized:
+            return self.bolus_grid(meal_size, us, h = h), us
+        if workers > 1:
+            meals = np.array([meal_size]).flatten()
+            args = [(u, m, h, False) for m in meals for u in us]
+            phis = np.array(parallel_map(self, _bolus_sim_task, args, workers)).reshape(len(meals), n)
+            if not isinstance(meal_size, (np.ndarray, list, tuple)):
+                phis = phis[0]
+            return phis, us
         if isinstance(meal_size, (np.ndarray, list, tuple)):
             return np.array([self.dense_meal_bolus(meal_size=m, min_bolus = min_bolus, max_bolus = max_bolus, n = n, h = h, PID = PID)[0] for m in meal_size]), us
         phis = np.array([])
@@ -273,32 +557,50 @@ class Patient(ODE):
             phis = np.append(phis, phi)
         return phis, us
     
-    def optimize_pid(self, meal_arr, uIs, **kwargs):
+    def optimize_pid(self, meal_arr, uIs, gradient = False, **kwargs):
+        """Finds PID parameters [Kp, Ti, Td] minimizing the summed penalty of a simulation with given inputs.
+        If gradient is True, the exact gradient is computed alongside each simulation with forward
+        sensitivities (see sensitivity.py) and L-BFGS-B is used. kwargs are passed to scipy.optimize.minimize.
+        """
         defaults = {
             "x0" : [0.5, 100, 10],
-            "bounds" : ((0, None), (0, None), (0, None)),
-            "method" : "Powell"
+            "bounds" : ((0, None), (1, None), (0, None)), # Ti divides the integral gain, so it is kept away from zero
+            "method" : "L-BFGS-B" if gradient else "Powell"
         }
         defaults.update(kwargs)
+        defaults.setdefault("jac", gradient) # with gradient, cost returns the penalty and its gradient
         pid_keys =  ["Kp", "Ti", "Td"]
         def cost(params):
             self.full_reset()
             for i,k in enumerate(pid_keys):
                 setattr(self.pumpObj, k, params[i])
+            if gradient:
+                return sensitivity.pid_cost_grad(self, ds = meal_arr, uIs = uIs)
             info = self.simulate(ds = meal_arr, uIs = uIs)
             return info["pens"].sum()
-        res = minimize(cost, **defaults)     
+        from scipy.optimize import minimize
+        res = minimize(cost, **defaults)
         for i,k in enumerate(pid_keys):
-            setattr(self, k, res.x[i])
+            setattr(self.pumpObj, k, res.x[i])
         self.full_reset()
         return res
 
-    def plan_treatment(self, meals):
+    def bolus_table(self, meal_sizes, **kwargs):
+        """Returns BolusTable with optimal boluses for given grid of meal sizes. kwargs are passed to best_bolus."""
+        return BolusTable(self, meal_sizes, **kwargs)
+
+    def plan_treatment(self, meals, table = None):
+        """Finds boluses for meals, and simulates with them before and after optimizing the PID.
+        If a BolusTable is given as table, boluses are looked up in it instead of optimized per meal.
+        """
         t = self.timestep
         meal_arr = utils.timestamp_arr(meals, t, fill = 0)
         bolus = []
         for m in meals:
-            u = self.best_bolus(meal_size = m[0])
+            if table is None:
+                u = self.best_bolus(meal_size = m[0])
+            else:
+                u = table.bolus_for(m[0])
             bolus.append([u, m[1]])
         bolus = np.array(bolus)
         uIs = utils.timestamp_arr(bolus, t, fill = None)
@@ -313,22 +615,8 @@ class Patient(ODE):
 
 
     def hist(self,G_arr):
-        bin_place=np.empty(len(G_arr))
-        for i, G in enumerate(G_arr):
-            if G <= 3:
-                bin_place[i]=0
-            elif 3<G<=3.9:
-                bin_place[i]=1
-            elif 3.9 < G <= 6:
-                bin_place[i]=2
-            elif 6 < G <=8:
-                bin_place[i]=3
-            elif 8 < G <=10:
-                bin_place[i]=4
-            elif 10 < G <= 13.9:
-                bin_place[i]=5
-            elif 13.9 < G:
-                bin_place[i]=6
+        bin_place=metrics.glucose_bins(G_arr)
+        import matplotlib.pyplot as plt
         plt.figure(figsize=(10,10))
         n,bins,patches=plt.hist(bin_place,bins=range(8),orientation="horizontal",align="left",density=True)
         colors=["#d00606","#f6065e","#00ff15","#0aebe7","#5d88ee","#0a0ac1","#00001c"]
@@ -367,6 +655,7 @@ class Patient(ODE):
         """
 
 
+        import matplotlib.pyplot as plt
         fig,ax=plt.subplots(nrows=shape[0],ncols=shape[1],figsize=size)
         ax=ax.flatten()
         colorlist=["#0B31A5","#D3004C","#107C10"]
@@ -441,12 +730,48 @@ class Patient(ODE):
         fig.tight_layout()
         return
 
-def find_ss(model, **kwargs): 
+_worker_patient = None # copy of patient in each worker process of parallel_map
+
+def _init_worker(patient):
+    global _worker_patient
+    _worker_patient = patient
+
+def _bolus_sim_task(args):
+    u, meal_size, h, PID = args
+    phi, _, _ = _worker_patient.bolus_sim(u, meal_size, meal_idx = 0, h = h, PID = PID)
+    return phi
+
+def _best_bolus_task(args):
+    meal_size, min_bolus, max_bolus, n, h, PID = args
+    return _worker_patient.best_bolus(meal_size, min_bolus = min_bolus, max_bolus = max_bolus, n = n, h = h, PID = PID)
+
+def parallel_map(patient, func, args, workers):
+    """Evaluates func on every element of args in a pool of worker processes.
+    The patient is pickled and sent once to each worker, where func can access it as _worker_patient.
+    Results are returned in the order of args.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    chunksize = max(1, len(args) // (4 * workers))
+    with ProcessPoolExecutor(max_workers = workers, initializer = _init_worker, initargs = (patient,)) as executor:
+        return list(executor.map(func, args, chunksize = chunksize))
+
+def _input_stream(arr, default):
+    """Returns iterator over input values for simulate_iter. Iterators are passed on, arrays are looped through."""
+    if arr is None:
+        return itertools.repeat(default)
+    if isinstance(arr, Schedule): # looped without making the dense array
+        return itertools.chain.from_iterable(itertools.repeat(arr))
+    if isinstance(arr, Iterator):
+        return (default if u is None else u for u in arr)
+    return itertools.cycle(np.array([arr], dtype=float).flatten())
+
+def find_ss(model, **kwargs):
     p = Patient(patient_type = 0, model = model, **kwargs)   
     def cost(G):
         _, isr = p.pancreasObj.steadystate(G)
         u = p.ssinv(G = G)
         return isr - u
+    from scipy.optimize import root_scalar
     return root_scalar(cost,  x0 = 4.8, x1 = 6,bracket = [3, 15], method="secant", xtol = 0.01)
 
 def baseline_patient(patient_type, model, Gbar = None, **kwargs):
@@ -460,7 +785,76 @@ def baseline_patient(patient_type, model, Gbar = None, **kwargs):
             patient.us = 0
         x0 = patient.ss(uI = patient.us, uP = uP)
         patient.update_state(x0) # set to steady state
-        for key in patient.state_keys: # also set "x0" values
-            setattr(patient, key+"0", getattr(patient, key))
+        patient.set_initial_state(x0) # also set "x0" values
         return patient
 
+def _rows(overrides):
+    """Returns list of dictionaries from a list of dictionaries or a dictionary of equally long columns."""
+    if isinstance(overrides, dict):
+        n = len(next(iter(overrides.values())))
+        return [{key: col[i] for key, col in overrides.items()} for i in range(n)]
+    return [dict(row) for row in overrides]
+
+def find_ss_cohort(model, overrides, bracket = (3, 15), **kwargs):
+    """Vectorized find_ss for many parameter sets.
+
+    Parameters
+    ----------
+    overrides : list of dictionaries of parameters, one per subject, or dictionary of columns
+        (e.g. {"BW" : [60, 80, 100]}). kwargs are shared by all subjects.
+
+    bracket : interval to search for the steady state glucose in.
+
+    Returns
+    -------
+    Array of the steady state glucose of each subject (nan if there is none in bracket).
+    """
+    from diabetessims.batch import Stack
+    rows = [{**kwargs, **row} for row in _rows(overrides)]
+    defaults = {**parameters.get("general"), **model.params}
+    subjects = Stack.from_dicts([{**defaults, **row} for row in rows])
+    pancreas_defaults = parameters.get("PKPM", "normal") # as find_ss, which uses a patient of type 0
+    pancreases = Stack.from_dicts([{**pancreas_defaults, **row.get("pancreas_param", {})} for row in rows])
+    def cost(G):
+        _, isr = pancreas.PKPM.steadystate(pancreases, G)
+        return isr - model.ssinv(subjects, G = G)
+    return utils.bracketed_root(cost, *bracket)
+
+def baseline_cohort(patient_type, model, overrides, Gbar = None, batch = False, **kwargs):
+    """Vectorized baseline_patient for many subjects.
+
+    The steady states of all subjects are found at once with find_ss_cohort (unless Gbar is given,
+    or a subject has its own Gbar), and the pancreases are not advanced to get their ISR.
+
+    Parameters
+    ----------
+    overrides : list of dictionaries of parameters, one per subject, or dictionary of columns.
+    kwargs : parameters shared by all subjects.
+    batch : if True, returns a PatientBatch of the subjects instead of a list of patients.
+    """
+    rows = [{**kwargs, **row} for row in _rows(overrides)]
+    Gs = np.array([row.pop("Gbar", np.nan if Gbar is None else Gbar) for row in rows], dtype=float)
+    missing = np.isnan(Gs)
+    if missing.any():
+        Gs[missing] = find_ss_cohort(model, [row for row, m in zip(rows, missing) if m])
+    patients = [Patient(patient_type = patient_type, model = model, Gbar = G, **row) for G, row in zip(Gs, rows)]
+
+    from diabetessims.batch import Stack, PatientBatch
+    subjects = Stack(patients)
+    if patient_type != 1:
+        _, uP = pancreas.PKPM.steadystate(Stack([p.pancreasObj for p in patients]), Gs)
+    else:
+        uP = np.zeros(len(patients))
+    if patient_type != 0:
+        us = np.maximum(0, model.ssinv(subjects, G = Gs, uP = uP))
+    else:
+        us = np.zeros(len(patients))
+    x0 = model.ss(subjects, uI = us, uP = uP)
+    for p, u, x in zip(patients, us, x0):
+        p.us = u
+        p.update_state(x) # set to steady state
+        p.set_initial_state(x) # also set "x0" values
+    if batch:
+        return PatientBatch(patients)
+    return patients
+
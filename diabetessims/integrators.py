@@ -0,0 +1,124 @@
+import numpy as np
+from scipy.integrate import solve_ivp
+
+
+def simulate_ivp(patient, ds, uIs, uPs, iterations, method = "RK45", **options):
+    """Runs the loop of Patient.simulate with an adaptive integrator from scipy.integrate.solve_ivp.
+
+    Takes the already prepared input arrays of Patient.simulate. Inputs are piecewise constant
+    over each timestep, and consecutive timesteps with the same inputs are integrated in one call,
+    with the solution sampled on the timestep grid. The pancreas (if any) is integrated together
+    with the patient, so ISR varies continuously and no substepping is needed. The PID pump is a
+    sampled controller: it is evaluated at every grid point, and while its output is used each
+    timestep is integrated separately. The solver then can not take steps longer than a timestep,
+    so with the pump in use (patient_type 1 and 2 with uIs None) a run takes seconds, and the
+    adaptive and stiff methods are only worthwhile for patient_type 0 or given insulin inputs.
+    Negative states are treated as zero inside the right hand side, and set to zero at the grid points,
+    as the ReLU after each euler step.
+
+    Parameters
+    ----------
+    method : integration method passed to solve_ivp, e.g. "RK45", "BDF", "Radau" or "LSODA".
+    options : passed to solve_ivp, e.g. rtol and atol.
+
+    Returns
+    -------
+    Info dictionary without penalties.
+    """
+    ds, uIs, uPs = [np.asarray(arr, dtype=float) for arr in (ds, uIs, uPs)]
+    n = len(patient.state_keys)
+    iG = patient._idx["G"]
+    iGsc = patient._idx["Gsc"]
+    pancreas = patient.pancreasObj if patient.type != 1 else None
+    timestep = patient.timestep
+
+    def isr(y):
+        """ISR at combined state y"""
+        if pancreas is None:
+            return 0
+        xp = y[n:]
+        return max(0, pancreas.get_ISR(y[iG], rho = xp[pancreas._idx["rho"]], DIR = xp[pancreas._idx["DIR"]]))
+
+    def inputs(i):
+        return ds[i%len(ds)], uIs[i%len(uIs)], uPs[i%len(uPs)]
+
+    def same(a, b):
+        """True if inputs a and b are equal, treating nan as equal to nan"""
+        return all(x == y or (np.isnan(x) and np.isnan(y)) for x, y in zip(a, b))
+
+    def rhs(t, y, d, uI, uP):
+        y = np.maximum(y, 0)
+        patient.update_state(y[:n])
+        if pancreas is None:
+            return patient.f_func(d = d, uI = uI, uP = uP)
+        pancreas.update_state(y[n:])
+        dxp, ISR = pancreas.sys(y[iG])
+        if np.isnan(uP):
+            uP = max(0, ISR)
+        return np.concatenate([patient.f_func(d = d, uI = uI, uP = uP), dxp])
+
+    def jac(t, y, d, uI, uP):
+        y = np.maximum(y, 0)
+        patient.update_state(y[:n])
+        J = patient.jac(d = d, uI = uI, uP = uP)
+        if pancreas is None:
+            return J
+        pancreas.update_state(y[n:])
+        G = y[iG]
+        J_full = np.zeros((len(y), len(y)))
+        J_full[:n, :n] = J
+        J_full[n:, n:] = pancreas.jac(G)
+        J_full[n:, iG] = pancreas.input_jac(G)
+        if np.isnan(uP): # uP is ISR of pancreas
+            B = patient.input_jac(d = d, uI = uI, uP = uP)[:, 2]
+            dISR, dISR_G = pancreas.ISR_jac(G)
+            J_full[:n, n:] += np.outer(B, dISR)
+            J_full[:n, iG] += B * dISR_G
+        return J_full
+
+    if method in ("BDF", "Radau", "LSODA"): # implicit methods use the analytic jacobian
+        options.setdefault("jac", jac)
+
+    states = np.empty((n, iterations+1)) # row i holds state_keys[i]
+    states[:, 0] = patient.x
+    info = dict(zip(patient.state_keys, states))
+    info["t"] = patient.time_arr(iterations+1)
+    info["uP"] = np.empty(iterations)
+    info["uI"] = np.empty(iterations)
+    info["d"] = np.empty(iterations)
+
+    y = patient.get_state() if pancreas is None else np.concatenate([patient.x, pancreas.x])
+    i = 0
+    while i < iterations:
+        d, uI, uP = inputs(i)
+        use_pump = patient.type != 0 and np.isnan(uI)
+        j = i + 1
+        if use_pump:
+            uI = patient.pump(y[iGsc])
+        else:
+            while j < iterations and same(inputs(j), inputs(i)):
+                j += 1
+            if np.isnan(uI): # no pump
+                uI = 0
+        if pancreas is None and np.isnan(uP): # no pancreas
+            uP = 0
+        t_eval = timestep * np.arange(i+1, j+1)
+        sol = solve_ivp(rhs, (timestep * i, t_eval[-1]), y, method = method, t_eval = t_eval, args = (d, uI, uP), **options)
+        if not sol.success:
+            raise RuntimeError(f"Integration failed at t = {timestep * i}: {sol.message}")
+        ys = np.maximum(sol.y, 0)
+        for k in range(i, j):
+            y_k = y if k == i else ys[:, k - i - 1] # state at start of timestep k
+            if patient.type != 0 and not use_pump: # pump is still evaluated to keep its state in sync
+                patient.pump(y_k[iGsc])
+            info["uP"][k] = isr(y_k) if np.isnan(uP) else uP
+            info["uI"][k] = uI
+            info["d"][k] = d
+        states[:, i+1:j+1] = ys[:n]
+        y = ys[:, -1]
+        i = j
+
+    patient.update_state(y[:n])
+    if pancreas is not None:
+        pancreas.update_state(y[n:])
+    return info
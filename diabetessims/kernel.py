@@ -0,0 +1,199 @@
+import numpy as np
+from . import pancreas
+
+try:
+    from numba import njit
+except ImportError: # numba is optional, without it the kernel runs as (slower) plain python
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
+# Parameters are passed to the kernel as float arrays in these orders
+MVP_keys = ["tau1", "tau2", "CI", "p2", "SI", "GEZI", "EGP0", "VG", "taum", "tausc"]
+HM_keys = ["tauig", "taud", "taus", "tausc", "F01", "EGP0", "MwG", "BW", "VI", "VG", "ke", "AG", "k12", "kb1", "kb2", "kb3", "ka1", "ka2", "ka3"]
+PKPM_keys = ["Gl", "Gu", "hhat", "delta2", "k", "eta", "gammab", "zeta", "rhob", "krho", "k1p", "k1m", "CT", "fb", "Kf", "I0", "N", "W", "timestep", "alpha1", "delta1", "v"]
+PID_keys = ["Kp", "Ti", "Td", "ybar", "timestep"]
+
+models = {"MVP" : (0, MVP_keys), "HM" : (1, HM_keys)}
+
+
+def pack(obj, keys):
+    """Returns parameters of obj as a flat float array. Parameters with two values (alpha1, delta1 and v) take up two entries."""
+    return np.hstack([getattr(obj, key) for key in keys]).astype(float)
+
+
+@njit(cache=True)
+def mvp_sys(p, x, d, uI, uP, dx):
+    """Same as MVP.sys, but writes the derivative to dx."""
+    tau1, tau2, CI, p2, SI, GEZI, EGP0, VG, taum, tausc = p[0], p[1], p[2], p[3], p[4], p[5], p[6], p[7], p[8], p[9]
+    D1, D2, Isc, Ip, Ieff, G, Gsc = x[0], x[1], x[2], x[3], x[4], x[5], x[6]
+    dx[0] = d - D1/taum
+    dx[1] = (D1 - D2)/taum
+    dx[2] = uI/(tau1 * CI) - Isc/tau1
+    dx[3] = (Isc - Ip + uP/CI)/tau2
+    dx[4] = -p2 * Ieff + p2 * SI * Ip
+    dx[5] = - (GEZI + Ieff) * G + EGP0 + 1000/18 * D2 / (VG * taum)
+    dx[6] = (G - Gsc) / tausc
+
+
+@njit(cache=True)
+def hm_sys(p, x, d, uI, uP, dx):
+    """Same as HM.sys, but writes the derivative to dx."""
+    tauig, taud, taus, tausc, F01, EGP0, MwG, BW, VI, VG = p[0], p[1], p[2], p[3], p[4], p[5], p[6], p[7], p[8], p[9]
+    ke, AG, k12, kb1, kb2, kb3, ka1, ka2, ka3 = p[10], p[11], p[12], p[13], p[14], p[15], p[16], p[17], p[18]
+    G, Gsc, Q1, Q2, S1, S2, I, x1, x2, x3, D1, D2 = x[0], x[1], x[2], x[3], x[4], x[5], x[6], x[7], x[8], x[9], x[10], x[11]
+    Gp = Q1/(VG * BW)
+    D = 1000 * d/MwG
+    F01c = min(1.0, G/4.5) * F01 * BW
+    FR = 0.003 * (G - 9) * VG * BW
+    if FR < 0:
+        FR = 0.0
+    UG = D2 / taus
+    UI = S2/taus
+    dx[0] = (Gp - G)/tauig
+    dx[1] = (G - Gsc) / tausc
+    dx[2] = UG - F01c - FR - x1 * Q1 + k12 * Q2 + BW * EGP0 * (1 - x3)
+    dx[3] = Q1 * x1 - (k12 + x2)*Q2
+    dx[4] = uI - S1 / taus
+    dx[5] = ((S1 - S2)/taus)
+    dx[6] = ((uP + UI) / (VI * BW) - ke * I)
+    dx[7] = kb1 * I - ka1 * x1
+    dx[8] = kb2 * I - ka2 * x2
+    dx[9] = kb3 * I - ka3 * x3
+    dx[10] = AG * D - D1 / taud
+    dx[11] = (D1 - D2)/taud
+
+
+pkpm_rhs = njit(cache=True)(pancreas.rhs) # the right hand side of the python pancreas, compiled
+
+
+@njit(cache=True)
+def pkpm_eval(p, x, G):
+    """Same as PKPM.eval. Advances pancreas state x one step and returns ISR."""
+    Gl, Gu, hhat, delta2, k, eta, gammab, zeta, rhob, krho = p[0], p[1], p[2], p[3], p[4], p[5], p[6], p[7], p[8], p[9]
+    k1p, k1m, CT, fb, Kf, I0, N, W, timestep = p[10], p[11], p[12], p[13], p[14], p[15], p[16], p[17], p[18]
+    if G <= Gl: # if glucose is low
+        alpha2 = 0.0
+        idx = 0
+        f = fb
+    else: # if glucose is high
+        idx = 1
+        if G <= Gu:
+            alpha2 = hhat * (G - Gl)/(Gu - Gl)
+        else:
+            alpha2 = hhat
+        f = fb + (1 - fb) *  (G - Gl) / (Kf +  G - Gl)
+    alpha1, delta1, v = p[19 + idx], p[21 + idx], p[23 + idx]
+    M, P, R, gamma, D, DIR, rho = x[0], x[1], x[2], x[3], x[4], x[5], x[6]
+
+    ISR = W * max(I0 * rho * DIR * f * N, 0.0)
+
+    dM, dP, dR, dgamma, dD, dDIR, drho = pkpm_rhs((M, P, R, gamma, D, DIR, rho), (v, delta1, alpha1, alpha2),
+        (delta2, k, eta, gammab, zeta, rhob, krho, k1p, k1m, CT))
+    x[0] = max(M + dM * timestep, 0.0)
+    x[1] = max(P + dP * timestep, 0.0)
+    x[2] = max(R + dR * timestep, 0.0)
+    x[3] = max(gamma + dgamma * timestep, 0.0)
+    x[4] = max(D + dD * timestep, 0.0)
+    x[5] = max(DIR + dDIR * timestep, 0.0)
+    x[6] = max(rho + drho * timestep, 0.0)
+    return ISR
+
+
+@njit(cache=True)
+def pid_eval(p, x, y):
+    """Same as PID.eval. Updates PID state x and returns control signal."""
+    Kp, Ti, Td, ybar, timestep = p[0], p[1], p[2], p[3], p[4]
+    I, yprev = x[0], x[1]
+    dy = (y - yprev)/timestep
+    P = Kp * (y - ybar)
+    res = P + I + Kp * Td * dy
+    x[0] = I + P/Ti * timestep
+    x[1] = y
+    return res
+
+
+@njit(cache=True)
+def run(model, p, x, timestep, ds, uIs, uPs, pk, xp, pancreas_n, pid, xpid, us, iG, iGsc, states, uI_out, uP_out, d_out):
+    """Runs the simulation loop of Patient.simulate.
+
+    pancreas_n = 0 means no pancreas and an empty pid means no pump.
+    x, xp and xpid are updated in place, states has shape (len(x), iterations + 1)
+    with the initial state in the first column.
+    """
+    n = x.shape[0]
+    dx = np.empty(n)
+    for i in range(states.shape[1] - 1):
+        d = ds[i % ds.shape[0]]
+
+        u_panc = 0.0
+        if pancreas_n > 0:
+            G = x[iG]
+            u = 0.0
+            for j in range(pancreas_n):
+                u += pkpm_eval(pk, xp, G)
+            u_panc = max(0.0, u/pancreas_n)
+        uP = uPs[i % uPs.shape[0]]
+        if np.isnan(uP):
+            uP = u_panc
+
+        u_pump = 0.0
+        if pid.shape[0] > 0:
+            u_pump = max(0.0, pid_eval(pid, xpid, x[iGsc]) + us)
+        uI = uIs[i % uIs.shape[0]]
+        if np.isnan(uI):
+            uI = u_pump
+
+        if model == 0:
+            mvp_sys(p, x, d, uI, uP, dx)
+        else:
+            hm_sys(p, x, d, uI, uP, dx)
+        for j in range(n):
+            x[j] = max(x[j] + dx[j] * timestep, 0.0) # euler step and ReLU
+            states[j, i + 1] = x[j]
+        uI_out[i] = uI
+        uP_out[i] = uP
+        d_out[i] = d
+
+
+def simulate(patient, ds, uIs, uPs, iterations):
+    """Runs the loop of Patient.simulate in a single compiled call.
+
+    Takes the already prepared input arrays of Patient.simulate (None entries in uIs and uPs
+    mean pump and pancreas respectively). The states of the patient, pancreas and pump are
+    updated in place, as with the python loop.
+
+    Returns
+    -------
+    Info dictionary without penalties.
+    """
+    if patient.type != 1 and patient.pancreas_method != "euler":
+        raise ValueError("The kernel only implements the euler pancreas, use engine = 'python' for pancreas_method = 'exponential'.")
+    model, keys = models[patient.model]
+    p = pack(patient, keys)
+    if patient.type != 1:
+        pk = pack(patient.pancreasObj, PKPM_keys)
+        xp = patient.pancreasObj.x
+        pancreas_n = int(patient.pancreas_n)
+    else:
+        pk, xp, pancreas_n = np.zeros(0), np.zeros(0), 0
+    if patient.type != 0:
+        pid = pack(patient.pumpObj, PID_keys)
+        xpid = patient.pumpObj.x
+        us = float(patient.us)
+    else:
+        pid, xpid, us = np.zeros(0), np.zeros(0), 0.0
+
+    states = np.empty((len(patient.state_keys), iterations + 1)) # row i holds state_keys[i]
+    states[:, 0] = patient.x
+    info = dict(zip(patient.state_keys, states))
+    info["t"] = patient.time_arr(iterations + 1)
+    info["uP"] = np.empty(iterations)
+    info["uI"] = np.empty(iterations)
+    info["d"] = np.empty(iterations)
+    run(model, p, patient.x, float(patient.timestep),
+        np.asarray(ds, dtype=float), np.asarray(uIs, dtype=float), np.asarray(uPs, dtype=float),
+        pk, xp, pancreas_n, pid, xpid, us,
+        patient._idx["G"], patient._idx["Gsc"], states, info["uI"], info["uP"], info["d"])
+    return info
@@ -0,0 +1,126 @@
+import numpy as np
+
+BINS = (3, 3.9, 6, 8, 10, 13.9) # edges of the glucose ranges of Patient.hist (mmol/L)
+
+
+def glucose_bins(G):
+    """Returns index of the range of each G: 0 for G <= 3, 1 for 3 < G <= 3.9, ..., 6 for G > 13.9"""
+    return np.searchsorted(BINS, G, side="left")
+
+
+def bin_counts(G):
+    """Returns number of samples of G in each range along the last axis, shape (..., 7)."""
+    G = np.asarray(G)
+    below = [np.count_nonzero(G <= edge, axis=-1) for edge in BINS] # one pass per edge, no (..., T, 7) array
+    below = np.stack([np.zeros_like(below[0])] + below + [np.full_like(below[0], G.shape[-1])], axis=-1)
+    return np.diff(below, axis=-1)
+
+
+def hypo_events(G, hypo = 3.9, below = False):
+    """Returns number of times G falls to hypo or lower along the last axis.
+    below tells if the sample before G was a hypo, so a hypo at the start is not counted twice."""
+    low = np.asarray(G) <= hypo
+    return np.count_nonzero(low[..., 1:] & ~low[..., :-1], axis=-1) + (low[..., 0] & ~np.asarray(below))
+
+
+class StreamSummary:
+    """Incremental summary of the chunks yielded by Patient.simulate_iter.
+
+    Keeps only running sums, so memory does not grow with the horizon. Works on chunks of shape (T,)
+    and (N, T), e.g. from a PatientBatch, in which case every summary has one entry per patient.
+    For whole simulations use summarize.
+
+    The penalty is integrated with the trapezoidal rule over the "t" of the chunks, which is the time base
+    of simulate, so it is a trapezoidal approximation of the Simpson integral of bolus_sim (Simpson's rule
+    can not be updated chunk by chunk). The chunks of simulate_iter do not hold the initial state,
+    so the interval from time 0 to the first sample is only included by summarize.
+
+    Parameters
+    ----------
+    low, high : range of time_in_range.
+    hypo : G at or below which a sample is a hypo.
+    patient : Patient or PatientBatch whose glucose_penalty is used with pen_func.
+        Defaults to using "pens" of the chunks.
+    pen_func : penalty function (1 or 2) used with patient.
+
+    Example
+    -------
+    summary = StreamSummary()
+    for info in p.simulate_iter(ds = meals, iterations = int(90 * 24 * 60 / p.timestep)):
+        summary.update(info)
+    summary.time_in_range, summary.penalty
+    """
+    def __init__(self, low = 3.9, high = 10, hypo = 3.9, patient = None, pen_func = None):
+        self.low = low
+        self.high = high
+        self.hypo = hypo
+        self.patient = patient
+        self.pen_func = pen_func
+        self.n = 0 # number of samples
+        self.in_range = 0
+        self.bins = 0 # number of samples in each of the ranges of BINS
+        self.hypos = 0 # number of hypo events
+        self.G_sum = 0
+        self.G_sq_sum = 0
+        self.penalty = 0 # trapezoidal integral of the penalty over time (in hours, like bolus_sim)
+        self._last = None # time, penalty and hypo of last sample, to join chunks
+
+    def update(self, info):
+        """Adds a chunk from simulate_iter."""
+        G = np.asarray(info["G"])
+        t = np.asarray(info["t"])/60
+        if self.patient is None:
+            pens = np.asarray(info["pens"])
+        else:
+            pens = self.patient.glucose_penalty(G, self.pen_func)
+        self.penalty = self.penalty + np.sum((pens[..., 1:] + pens[..., :-1]) * np.diff(t), axis=-1)/2
+        below = False
+        if self._last is not None:
+            t_last, pen_last, below = self._last
+            self.penalty = self.penalty + (pens[..., 0] + pen_last) * (t[..., 0] - t_last)/2
+        self._last = (t[..., -1], pens[..., -1], G[..., -1] <= self.hypo)
+        self.n += G.shape[-1]
+        self.in_range = self.in_range + np.count_nonzero((G >= self.low) & (G <= self.high), axis=-1)
+        self.bins = self.bins + bin_counts(G)
+        self.hypos = self.hypos + hypo_events(G, self.hypo, below)
+        self.G_sum = self.G_sum + np.sum(G, axis=-1)
+        self.G_sq_sum = self.G_sq_sum + np.sum(G**2, axis=-1)
+        return self
+
+    @property
+    def time_in_range(self):
+        """Fraction of samples with low <= G <= high"""
+        return self.in_range / self.n
+
+    @property
+    def time_in_ranges(self):
+        """Fraction of samples in each of the ranges of BINS, shape (..., 7)"""
+        return self.bins / self.n
+
+    @property
+    def mean(self):
+        """Mean blood glucose"""
+        return self.G_sum / self.n
+
+    @property
+    def cv(self):
+        """Coefficient of variation of blood glucose (standard deviation over mean)"""
+        mean = self.mean
+        return np.sqrt(np.maximum(self.G_sq_sum / self.n - mean**2, 0)) / mean
+
+    def result(self):
+        """Returns the summaries as a dictionary."""
+        return {
+            "penalty" : self.penalty,
+            "time_in_range" : self.time_in_range,
+            "time_in_ranges" : self.time_in_ranges,
+            "hypo_events" : self.hypos,
+            "mean" : self.mean,
+            "cv" : self.cv
+        }
+
+
+def summarize(info, **kwargs):
+    """Returns StreamSummary.result of a whole simulation, e.g. the output of simulate,
+    PatientBatch.simulate or SimulationStore.info. kwargs are passed to StreamSummary."""
+    return StreamSummary(**kwargs).update(info).result()
@@ -1,29 +1,68 @@
 import numpy as np
 class ODE:
+    """Base class for models with a state vector.
+
+    The states listed in state_keys are stored in one contiguous float64 buffer, self.x,
+    and their initial values in self.x0. The states can still be read and written as
+    attributes (e.g. self.G or self.G0), which are mapped onto the buffers.
+    """
     def __init__(self, data):
-        for key, value in data.items():
-            setattr(self, key, value)
+        state_keys = data.get("state_keys", 0)
+        if not state_keys:
+            state_keys = list(data.keys())
+        # set through __dict__ so that __setattr__ can rely on them
+        self.__dict__["_idx"] = {key: i for i, key in enumerate(state_keys)}
+        self.__dict__["_idx0"] = {key+"0": i for i, key in enumerate(state_keys)}
+        self.x = np.array([data[key] for key in state_keys], dtype=float)
+        self.x0 = self.x.copy()
 
-        if not getattr(self, "state_keys",0):
-            self.state_keys = list(data.keys())
+        d = self.__dict__
+        for key, value in data.items():
+            if key in d["_idx"]: # already in x
+                continue
+            if key in d["_idx0"]:
+                setattr(self, key, value)
+            else: # plain parameter, skips __setattr__
+                d[key] = value
+        self.state_keys = list(state_keys)
         if not getattr(self, "timestep",0):
             self.timestep = 1
-        for key in self.state_keys:
-            setattr(self, key+"0", data[key])
+
+    def __getattr__(self, name):
+        # only called when normal lookup fails, i.e. for states
+        d = self.__dict__
+        if "_idx" in d:
+            if name in d["_idx"]:
+                return d["x"][d["_idx"][name]]
+            if name in d["_idx0"]:
+                return d["x0"][d["_idx0"][name]]
+        raise AttributeError(f"{type(self).__name__!r} object has no attribute {name!r}")
+
+    def __setattr__(self, name, value):
+        d = self.__dict__
+        if "_idx" in d:
+            if name in d["_idx"]:
+                d["x"][d["_idx"][name]] = value
+                return
+            if name in d["_idx0"]:
+                d["x0"][d["_idx0"][name]] = value
+                return
+        object.__setattr__(self, name, value)
+
     def __str__(self):
-        return str(self.__dict__)
-        
+        states = dict(zip(self.state_keys, self.x))
+        return str({**self.__dict__, **states})
+
     def get_state(self):
-        """Update state vector to values given by input"""
-        x = np.array([getattr(self,key) for key in self.state_keys])
-        return x
+        """Returns copy of state vector"""
+        return self.x.copy()
 
     def get_initial_state(self):
-        return np.array([getattr(self,key+"0") for key in self.state_keys])
+        return self.x0.copy()
 
     def get_attr(self, states, attr):
         """Returns column of state matrix with idx matching given attribute"""
-        idx = self.state_keys.index(attr) # Finds the index of desired attribute
+        idx = self._idx[attr] # Finds the index of desired attribute
         if states.ndim == 2:
             return states[:,idx]
         else:
@@ -31,14 +70,17 @@ class ODE:
 
     def update_state(self, x_new):
         """Update state vector to values given by input"""
-        for key, val in zip(self.state_keys, x_new):
-            setattr(self, key, val)
+        self.x[:] = x_new
+        return
+
+    def set_initial_state(self, x0):
+        """Update initial state vector to values given by input"""
+        self.x0[:] = x0
         return
 
     def reset(self):
         """Resets state to x0"""
-        x0 = self.get_initial_state()
-        self.update_state(x0)
+        self.x[:] = self.x0
         return
 
     def time_arr(self, length):
@@ -47,12 +89,11 @@ class ODE:
     def euler_step(self, dx):
         """
         Updates state using state vector derivative and one step of eulers method.
-        
+
         Parameters
         ----------
         dx : numpy array
             Derivative of state vector.
         """
-        x_new = self.get_state() + dx * self.timestep
-        self.update_state(x_new)
+        self.x += dx * self.timestep
         return
@@ -1,33 +1,22 @@
 import numpy as np
 from diabetessims.odeclass import ODE
-import json
 from . import utils
+from . import parameters
 
     
 class PKPM(ODE):
     def __init__(self, patient_type = 0, Gbar = None, **kwargs):
-        with open('diabetessims/config.json', 'r') as f:
-            defaults = json.load(f)["PKPM"]
-
         if patient_type == 2 :
-            remove = "normal"
-            keep = "T2"
+            variant = "T2"
         else:
-            remove = "T2"
-            keep = "normal"
-
-        del defaults[remove]
-        for key, item in defaults[keep].items():
-            defaults[key] = item
-        del defaults[keep]
-
+            variant = "normal"
+        defaults = dict(parameters.get("PKPM", variant))
         defaults.update(kwargs)
         super().__init__(defaults)
         if Gbar is not None: # if a desired glucose level is given
             x0, _ = self.steadystate(Gbar) # find steady state with given parameters
             self.update_state(x0) # set to steady state
-            for key in self.state_keys: # also set "x0" values
-                setattr(self, key+"0", getattr(self, key))
+            self.set_initial_state(x0) # also set "x0" values
 
     def get_ISR(self, G, **kwargs):
         if G <= self.Gl: # if glucose is low
@@ -35,9 +24,10 @@ class PKPM(ODE):
         else: # if glucose is high
             f = self.fb + (1 - self.fb) *  (G - self.Gl) / (self.Kf +  G - self.Gl)
         I0 = kwargs.get("I0", self.I0)
-        rho = kwargs.get("rho", self.rho)
-        DIR = kwargs.get("DIR", self.DIR)
         N = kwargs.get("N", self.N)
+        # states are only looked up when not given
+        rho = kwargs["rho"] if "rho" in kwargs else self.rho
+        DIR = kwargs["DIR"] if "DIR" in kwargs else self.DIR
         return self.W * max(I0 * rho * DIR * f * N,0) # do not let isr be negative
 
     def get_dependant_vars(self, G):
@@ -57,27 +47,69 @@ class PKPM(ODE):
 
 
     def sys(self, G):
-        v, delta1, alpha1, alpha2 = self.get_dependant_vars(G)
-        # ode
-        dM = alpha1 - delta1 * self.M
-        dP = v * self.M - self.delta2 * self.P - self.k * self.P * self.rho * self.DIR
-        dR =  self.k * self.P * self.rho * self.DIR - self.gamma * self.R
-        dgamma = self.eta * (-self.gamma + self.gammab + alpha2)
-        dD = self.gamma * self.R - self.k1p * (self.CT - self.DIR) * self.D + self.k1m * self.DIR
-        dDIR = self.k1p * (self.CT - self.DIR) * self.D - self.k1m * self.DIR - self.rho * self.DIR
-        drho = self.zeta * (-self.rho + self.rhob + self.krho * (self.gamma - self.gammab))
-        dx = np.array([dM, dP, dR, dgamma, dD, dDIR, drho])
-        ISR = self.get_ISR(G)
+        x = self.x.tolist()
+        dx = np.array(rhs(x, self.get_dependant_vars(G), rhs_params(self)))
+        ISR = self.get_ISR(G, rho = x[6], DIR = x[5])
         return dx, ISR
 
 
+    def jac(self, G):
+        """Returns Jacobian of sys with respect to the state, J[i, j] = d(dx_i)/d(x_j)."""
+        return jac(self.x, self.get_dependant_vars(G), rhs_params(self))
+
+    def input_jac(self, G):
+        """Returns derivative of sys with respect to G. Jumps of the parameters at Gl are ignored."""
+        dx = np.zeros(7)
+        if self.Gl < G <= self.Gu:
+            dx[3] = self.eta * self.hhat / (self.Gu - self.Gl) # gamma
+        return dx
+
+    def ISR_jac(self, G):
+        """Returns derivatives of ISR with respect to the state and with respect to G."""
+        rho, DIR = self.rho, self.DIR
+        if G <= self.Gl:
+            f = self.fb
+            df = 0
+        else:
+            f = self.fb + (1 - self.fb) *  (G - self.Gl) / (self.Kf +  G - self.Gl)
+            df = (1 - self.fb) * self.Kf / (self.Kf +  G - self.Gl)**2
+        dx = np.zeros(7)
+        if self.I0 * rho * DIR * f * self.N <= 0: # ISR is cut off at zero
+            return dx, 0
+        c = self.W * self.I0 * self.N
+        dx[5] = c * rho * f # DIR
+        dx[6] = c * DIR * f # rho
+        return dx, c * rho * DIR * df
+
     def steadystate(self, G):
-        v, delta1, alpha1, alpha2 = self.get_dependant_vars(G)
+        """Returns steady state and ISR for glucose G. G can be an array, giving x0 of shape (..., 7)."""
+        if np.ndim(G) == 0 and isinstance(self, PKPM): # plain floats are faster for a single G
+            return self._steadystate_scalar(G)
+        v, delta1, alpha1, alpha2 = dependant_vars(self, G)
         # ode
         M = alpha1/delta1
         gamma = self.gammab + alpha2
         rho = self.rhob + self.krho * alpha2
 
+        expr1 =  self.k * v * alpha1  - delta1 * self.delta2
+        expr2 = self.CT * self.k * delta1 * (self.rhob + self.krho * alpha2)
+        secreting = (expr1 > 0) & (expr2 > expr1)
+        with np.errstate(divide="ignore", invalid="ignore"): # both cases are evaluated
+            P = np.where(secreting, 1/self.k, v * alpha1 / delta1 / self.delta2)
+            R = np.where(secreting, (v * M - P*self.delta2)/gamma, 0)
+            DIR = np.where(secreting, R * gamma / rho, 0)
+            D = np.where(secreting, (self.k1m * DIR + rho * DIR)/ (self.k1p * (self.CT - DIR)), 0)
+        x0 = utils.stack_states(M, P, R, gamma, D, DIR, rho)
+        ISR = self.W * np.maximum(self.I0 * rho * DIR * secretion_factor(self, G) * self.N, 0)
+        return x0, ISR[()]
+    
+
+    def _steadystate_scalar(self, G):
+        v, delta1, alpha1, alpha2 = self.get_dependant_vars(G)
+        M = alpha1/delta1
+        gamma = self.gammab + alpha2
+        rho = self.rhob + self.krho * alpha2
+
         expr1 =  self.k * v * alpha1  - delta1 * self.delta2
         expr2 = self.CT * self.k * delta1 * (self.rhob + self.krho * alpha2)
         if (expr1 > 0) and (expr2 > expr1):
@@ -92,19 +124,194 @@ class PKPM(ODE):
             DIR = 0
         x0 = np.array([M, P, R, gamma, D, DIR, rho])
         ISR = self.get_ISR(G, rho = rho, DIR = DIR)
-
-
         return x0, ISR
-    
 
     def eval(self, G):
         dx, ISR = self.sys(G)
-        x_new = dx * self.timestep + self.get_state()
-        x_new = utils.ReLU(x_new)
-        self.update_state(x_new)
+        self.euler_step(dx)
+        self.update_state(utils.ReLU(self.x))
         return ISR
 
 
+def dependant_vars(p, G):
+    """Branchless PKPM.get_dependant_vars. G can be an array, and p a PKPM or a batch.Stack of them."""
+    high = G > p.Gl # glucose above lower level
+    alpha1, delta1, v = [np.asarray(arr) for arr in (p.alpha1, p.delta1, p.v)]
+    alpha2 = np.where(high, np.where(G <= p.Gu, p.hhat * (G - p.Gl)/(p.Gu - p.Gl), p.hhat), 0)
+    return (np.where(high, v[..., 1], v[..., 0]), np.where(high, delta1[..., 1], delta1[..., 0]),
+            np.where(high, alpha1[..., 1], alpha1[..., 0]), alpha2)
+
+
+def secretion_factor(p, G):
+    """Branchless f of PKPM.get_ISR"""
+    return np.where(G > p.Gl, p.fb + (1 - p.fb) *  (G - p.Gl) / (p.Kf +  G - p.Gl), p.fb)
+
+
+RHS_KEYS = ("delta2", "k", "eta", "gammab", "zeta", "rhob", "krho", "k1p", "k1m", "CT") # parameters of rhs, in order
+
+
+def rhs_params(p):
+    """Returns the parameters of rhs of a PKPM or a batch.Stack of them."""
+    return tuple(getattr(p, key) for key in RHS_KEYS)
+
+
+def rhs(x, dep, c):
+    """Right hand side of the PKPM equations, shared by PKPM.sys, advance and the compiled kernel (kernel.py).
+
+    x holds the states M, P, R, gamma, D, DIR and rho, dep the dependant variables (v, delta1, alpha1, alpha2)
+    of get_dependant_vars, and c the parameters of RHS_KEYS (see rhs_params). It has no branches, so the
+    values can be floats or arrays. Returns the derivatives of the states as a tuple.
+    """
+    M, P, R, gamma, D, DIR, rho = x
+    v, delta1, alpha1, alpha2 = dep
+    delta2, k, eta, gammab, zeta, rhob, krho, k1p, k1m, CT = c
+    dM = alpha1 - delta1 * M
+    dP = v * M - delta2 * P - k * P * rho * DIR
+    dR =  k * P * rho * DIR - gamma * R
+    dgamma = eta * (-gamma + gammab + alpha2)
+    dD = gamma * R - k1p * (CT - DIR) * D + k1m * DIR
+    dDIR = k1p * (CT - DIR) * D - k1m * DIR - rho * DIR
+    drho = zeta * (-rho + rhob + krho * (gamma - gammab))
+    return dM, dP, dR, dgamma, dD, dDIR, drho
+
+
+def advance(p, x, G, n = 1, method = "euler"):
+    """Advances pancreas states x (shape (..., 7)) n euler steps of p.timestep with constant glucose G.
+
+    Vectorized PKPM.eval repeated n times: the regime of G is only selected once, and
+    x can hold a batch of states (one per element of G and/or one per pancreas in p).
+    x is updated in place. If method is "exponential", advance_exponential is used instead.
+
+    Returns
+    -------
+    Mean ISR of the steps, cut off at zero (as Patient.pancreas).
+    """
+    if method == "exponential":
+        return advance_exponential(p, x, G, n)
+    if method != "euler":
+        raise ValueError(f"Unknown pancreas method {method!r}, use 'euler' or 'exponential'.")
+    if x.ndim == 1 and np.ndim(G) == 0: # single pancreas, plain floats are faster than numpy
+        return _advance_scalar(p, x, float(G), n)
+    dep = dependant_vars(p, G)
+    c = rhs_params(p)
+    f = secretion_factor(p, G)
+    h = p.timestep
+    u = 0
+    for i in range(n):
+        states = np.moveaxis(x, -1, 0)
+        u += p.W * np.maximum(p.I0 * states[6] * states[5] * f * p.N, 0) # rho and DIR
+        dx = np.stack(rhs(states, dep, c), axis=-1)
+        x += dx * np.expand_dims(h, -1)
+        x[:] = utils.ReLU(x)
+    return np.maximum(0, u/n)
+
+
+def jac(x, dep, c):
+    """Jacobian of rhs with respect to x, of shape (..., 7, 7) with J[..., i, j] = d(dx_i)/d(x_j).
+    The arguments are those of rhs, and can be floats or arrays."""
+    M, P, R, gamma, D, DIR, rho = x
+    v, delta1, alpha1, alpha2 = dep
+    delta2, k, eta, gammab, zeta, rhob, krho, k1p, k1m, CT = c
+    iM, iP, iR, igamma, iD, iDIR, irho = range(7)
+    J = np.zeros(np.broadcast(M, v, k).shape + (7, 7))
+    J[..., iM, iM] = -delta1
+    J[..., iP, iM] = v
+    J[..., iP, iP] = -delta2 - k * rho * DIR
+    J[..., iP, irho] = -k * P * DIR
+    J[..., iP, iDIR] = -k * P * rho
+    J[..., iR, iP] = k * rho * DIR
+    J[..., iR, irho] = k * P * DIR
+    J[..., iR, iDIR] = k * P * rho
+    J[..., iR, igamma] = -R
+    J[..., iR, iR] = -gamma
+    J[..., igamma, igamma] = -eta
+    J[..., iD, igamma] = R
+    J[..., iD, iR] = gamma
+    J[..., iD, iD] = -k1p * (CT - DIR)
+    J[..., iD, iDIR] = k1p * D + k1m
+    J[..., iDIR, iD] = k1p * (CT - DIR)
+    J[..., iDIR, iDIR] = -k1p * D - k1m - rho
+    J[..., iDIR, irho] = -DIR
+    J[..., irho, igamma] = zeta * krho
+    J[..., irho, irho] = -zeta
+    return J
+
+
+def advance_exponential(p, x, G, n = 1, h = None):
+    """Same as advance, but with an exponential Rosenbrock integrator that is stable for any step size.
+
+    Each step linearizes the equations at the current state (rhs and jac) and solves the linearization
+    exactly, through the exponential of an augmented matrix. The step is second order, and exact where
+    the equations are linear, as for M, gamma and rho with constant G. The returned ISR is computed
+    from the means of rho and DIR over the steps, which come from the same exponential.
+    h is the step size, and defaults to p.timestep.
+    """
+    if h is None:
+        h = p.timestep
+    if x.ndim == 1 and np.ndim(G) == 0: # single pancreas, plain floats are faster than numpy
+        G = float(G)
+        dep = p.get_dependant_vars(G)
+        isr = p.W * p.I0 * float(secretion_factor(p, G)) * p.N
+    else:
+        dep = dependant_vars(p, G)
+        isr = p.W * p.I0 * secretion_factor(p, G) * p.N
+    c = rhs_params(p)
+    h = np.asarray(h, dtype=float)
+    u = 0
+    for i in range(n):
+        x1, xm = _rosenbrock_step(x, dep, c, h)
+        x[:] = utils.ReLU(x1)
+        u += np.maximum(isr * xm[..., 6] * xm[..., 5], 0) # rho and DIR
+    return np.maximum(0, u/n)
+
+
+def _rosenbrock_step(x, dep, c, h):
+    """One step of advance_exponential. Returns the states after the step (not yet cut off at zero)
+    and their mean over the step, x + h phi1(h J) f and x + h phi2(h J) f, where f = rhs and J = jac at x.
+
+    The exponential is taken of [[h J, h f, 0], [0, 0, 1], [0, 0, 0]], with the states scaled by
+    their size, as the entries of J range over several orders of magnitude.
+    """
+    if x.ndim == 1:
+        states = x.tolist()
+        f = np.array(rhs(states, dep, c)) * h
+    else:
+        states = np.moveaxis(x, -1, 0)
+        f = np.stack(np.broadcast_arrays(*rhs(states, dep, c)), axis=-1) * h[..., None]
+    J = jac(states, dep, c)
+    scale = np.abs(x) + np.abs(f)
+    scale = np.maximum(scale, 1e-8 * scale.max(axis=-1, keepdims=True) + 1e-300)
+    A = np.zeros(J.shape[:-2] + (9, 9))
+    A[..., :7, :7] = J * h[..., None, None] * scale[..., None, :] / scale[..., :, None]
+    A[..., :7, 7] = f / scale
+    A[..., 7, 8] = 1
+    E = utils.expm(A)
+    return x + scale * E[..., :7, 7], x + scale * E[..., :7, 8]
+
+
+def _advance_scalar(p, x, G, n):
+    """advance for a single pancreas"""
+    dep = p.get_dependant_vars(G)
+    c = rhs_params(p)
+    f = float(secretion_factor(p, G))
+    I0, N, W = p.I0, p.N, p.W
+    h = p.timestep
+    M, P, R, gamma, D, DIR, rho = x.tolist()
+    u = 0
+    for i in range(n):
+        u += W * max(I0 * rho * DIR * f * N, 0)
+        dM, dP, dR, dgamma, dD, dDIR, drho = rhs((M, P, R, gamma, D, DIR, rho), dep, c)
+        M = max(M + dM * h, 0)
+        P = max(P + dP * h, 0)
+        R = max(R + dR * h, 0)
+        gamma = max(gamma + dgamma * h, 0)
+        D = max(D + dD * h, 0)
+        DIR = max(DIR + dDIR * h, 0)
+        rho = max(rho + drho * h, 0)
+    x[:] = M, P, R, gamma, D, DIR, rho
+    return max(0, u/n)
+
+
 class PID(ODE):
     def __init__(self, Kp, Td, Ti, ybar, timestep):
         data = {
@@ -120,16 +327,17 @@ class PID(ODE):
         super().__init__(data)
 
     def eval(self,y):
-        dy = (y - self.yprev)/self.timestep
+        I, yprev = self.x
+        dy = (y - yprev)/self.timestep
         ek = y - self.ybar
 
         P = self.Kp * ek 
         dI = P/self.Ti # 
         D = self.Kp * self.Td * dy
 
-        res = P + self.I + D
+        res = P + I + D
 
-        self.yprev = y 
-        self.I += dI * self.timestep # Updates integral term
+        self.x[0] = I + dI * self.timestep # Updates integral term
+        self.x[1] = y
         return res        
 
@@ -0,0 +1,78 @@
+import json
+import os
+from types import MappingProxyType
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.json")
+
+_overrides = [] # paths of user supplied override files, applied in order
+_data = None # merged config, read on first use
+_profiles = {} # frozen profiles by (name, variant)
+
+
+def freeze(value):
+    """Returns read-only copy of value, with dictionaries as mappingproxies and lists as tuples."""
+    if isinstance(value, dict):
+        return MappingProxyType({key: freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+def merge(base, new):
+    """Recursively updates dictionary base with new."""
+    for key, value in new.items():
+        if isinstance(value, dict) and isinstance(base.get(key), dict):
+            merge(base[key], value)
+        else:
+            base[key] = value
+    return base
+
+
+def read():
+    """Returns config.json of the package merged with the override files. The files are only read once."""
+    global _data
+    if _data is None:
+        with open(CONFIG_PATH, "r") as f:
+            data = json.load(f)
+        for path in _overrides:
+            with open(path, "r") as f:
+                merge(data, json.load(f))
+        _data = data
+    return _data
+
+
+def get(name, variant = None):
+    """Returns read-only parameters of a profile in the config, e.g. get("general"), get("HM") or get("PKPM", "T2").
+
+    Entries of a section that are themselves dictionaries are variants (e.g. "normal" and "T2" for PKPM).
+    They are left out, unless one is chosen with variant, in which case its entries are added.
+    Use dict(get(...)) to get a modifiable copy.
+    """
+    key = (name, variant)
+    if key not in _profiles:
+        section = read()[name]
+        params = {k: v for k, v in section.items() if not isinstance(v, dict)}
+        if variant is not None:
+            params.update(section[variant])
+        _profiles[key] = freeze(params)
+    return _profiles[key]
+
+
+def load_overrides(path):
+    """Adds a json file with the same layout as config.json, whose values override the defaults.
+    Only affects objects created afterwards."""
+    _overrides.append(os.path.abspath(path))
+    clear()
+
+
+def reset():
+    """Removes all override files."""
+    _overrides.clear()
+    clear()
+
+
+def clear():
+    """Clears the loaded config, so the files are read again on next use."""
+    global _data
+    _data = None
+    _profiles.clear()
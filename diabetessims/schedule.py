@@ -0,0 +1,131 @@
+import numpy as np
+
+
+class Schedule:
+    """Piecewise constant input (e.g. meals or boluses) stored as a list of segments.
+
+    Segment i has the value values[i] in iterations breaks[i] <= k < breaks[i+1], so long periods
+    without events take up no space. A Schedule can be passed as ds, uIs or uPs to Patient.simulate
+    and simulate_iter, or turned into a normal input array with dense() or np.asarray.
+    Only simulate_iter and simulate with integrator = "events" read the segments as they are. The other
+    integrators and engines of simulate expand the Schedule into an array with one value per iteration.
+
+    Parameters
+    ----------
+    breaks : increasing iteration indices, starting at 0. The last is the number of iterations.
+    values : value of each segment. nan means pump/pancreas, as in the input arrays of simulate.
+    """
+    def __init__(self, breaks, values):
+        self.breaks = np.asarray(breaks, dtype=int)
+        self.values = np.asarray(values, dtype=float)
+        if len(self.breaks) != len(self.values) + 1 or self.breaks[0] != 0 or np.any(np.diff(self.breaks) <= 0):
+            raise ValueError("breaks must be increasing from 0 and have one more element than values.")
+
+    def __len__(self):
+        return int(self.breaks[-1])
+
+    def __iter__(self):
+        """Yields the value of each iteration"""
+        for value, n in zip(self.values.tolist(), np.diff(self.breaks).tolist()):
+            for i in range(n):
+                yield value
+
+    def __array__(self, dtype = None, copy = None):
+        return self.dense() if dtype is None else self.dense().astype(dtype)
+
+    def dense(self):
+        """Returns the input array with one value per iteration."""
+        return np.repeat(self.values, np.diff(self.breaks))
+
+    def segments(self):
+        """Returns list of (start, stop, value) of the segments"""
+        return list(zip(self.breaks[:-1].tolist(), self.breaks[1:].tolist(), self.values.tolist()))
+
+    def value_at(self, i):
+        """Returns the value in iteration i. i can be an array."""
+        return self.values[np.searchsorted(self.breaks, i, side="right") - 1]
+
+
+def as_schedule(arr, iterations, default = 0):
+    """Returns input of simulate (None, number, array or Schedule) as a Schedule of the given length.
+    Arrays and Schedules are looped through, as in simulate, and None gives default."""
+    if arr is None:
+        return Schedule([0, iterations], [default])
+    if not isinstance(arr, Schedule):
+        arr = np.array([arr], dtype=float).flatten()
+        change = np.flatnonzero((arr[1:] != arr[:-1]) & ~(np.isnan(arr[1:]) & np.isnan(arr[:-1]))) + 1
+        arr = Schedule(np.concatenate([[0], change, [len(arr)]]), arr[np.concatenate([[0], change])])
+    n = len(arr)
+    reps = -(-iterations // n) # number of loops needed
+    breaks = (arr.breaks[:-1] + n * np.arange(reps)[:, None]).flatten()
+    values = np.tile(arr.values, reps)
+    keep = breaks < iterations
+    breaks, values = breaks[keep], values[keep]
+    same = np.concatenate([[False], (values[1:] == values[:-1]) | (np.isnan(values[1:]) & np.isnan(values[:-1]))])
+    return Schedule(np.append(breaks[~same], iterations), values[~same])
+
+
+def compile_schedule(table, timestep, days = None, fill = 0, h = 24):
+    """Builds the input of a multi-day meal or bolus plan in one vectorized pass.
+
+    Parameters
+    ----------
+    table : array with rows (day, amount, start) for amounts given at once, or (day, amount, start, end)
+        for amounts spread evenly over [start, end). start and end are in hours since the start of the day,
+        and end is nan for amounts given at once. The units are as in timestamp_arr.
+    timestep : timestep of the patient.
+    days : number of days. Defaults to the last day in table.
+    fill : value outside the entries, 0 for meals or nan (None) to use the pump for insulin.
+    h : hours per day.
+
+    Returns
+    -------
+    Schedule. Overlapping entries are added.
+    """
+    if not isinstance(table, np.ndarray) and len(table) and np.ndim(table[0]) == 1: # rows can have 3 or 4 columns
+        if any(len(row) not in (3, 4) for row in table):
+            raise ValueError("Rows of table must be (day, amount, start) or (day, amount, start, end).")
+        table = [list(row) + [np.nan] * (4 - len(row)) for row in table]
+    table = np.array(table, dtype=float, ndmin=2)
+    if table.size == 0:
+        table = np.empty((0, 4))
+    if table.shape[1] not in (3, 4):
+        raise ValueError("Rows of table must be (day, amount, start) or (day, amount, start, end).")
+    if table.shape[1] == 3:
+        table = np.hstack([table, np.full((len(table), 1), np.nan)])
+    day, amount, start, end = table.T
+    n = int(h * 60 / timestep) # iterations per day
+    if days is None:
+        days = int(day.max()) + 1 if len(day) else 1
+    iterations = days * n
+    offset = day.astype(int) * n
+    i0 = offset + (start / timestep * 60).astype(int)
+    spread = ~np.isnan(end)
+    i1 = np.where(spread, offset + (np.where(spread, end, 0) / timestep * 60).astype(int), i0 + 1)
+    i0, i1 = np.clip(i0, 0, iterations), np.clip(i1, 0, iterations)
+    keep = i1 > i0 # entries with end before start are empty, as in timestamp_arr
+    i0, i1, amount, spread = i0[keep], i1[keep], amount[keep], spread[keep]
+    rate = np.where(spread, amount/(i1 - i0)/timestep, amount/timestep)
+
+    # sum of rates and number of entries covering each segment, from the changes at the entry ends
+    points, inverse = np.unique(np.concatenate([[0, iterations], i0, i1]), return_inverse=True)
+    m = len(i0)
+    change = np.zeros(len(points))
+    count = np.zeros(len(points), dtype=int)
+    np.add.at(change, inverse[2:2 + m], rate)
+    np.add.at(change, inverse[2 + m:], -rate)
+    np.add.at(count, inverse[2:2 + m], 1)
+    np.add.at(count, inverse[2 + m:], -1)
+    starts = points[:-1]
+    values = np.cumsum(change)[:-1]
+    covered = np.cumsum(count)[:-1]
+    # where a single entry covers a segment, use its rate, which is free of rounding from the sum
+    if m:
+        order = np.argsort(i0, kind="stable")
+        j = order[np.maximum(np.searchsorted(i0[order], starts, side="right") - 1, 0)] # last entry started
+        values = np.where((covered == 1) & (i0[j] <= starts) & (i1[j] > starts), rate[j], values)
+    fill = np.nan if fill is None else fill
+    values = np.where(covered > 0, values, fill)
+    # merge neighbouring segments with the same value
+    same = np.concatenate([[False], (values[1:] == values[:-1]) | (np.isnan(values[1:]) & np.isnan(values[:-1]))])
+    return Schedule(np.append(starts[~same], iterations), values[~same])
@@ -0,0 +1,88 @@
+import numpy as np
+
+
+def pid_cost_grad(patient, ds = None, uIs = None, uPs = None, iterations = None):
+    """Simulates patient like Patient.simulate and returns the summed penalty and its gradient
+    with respect to the PID parameters [Kp, Ti, Td].
+
+    The gradient is exact for the euler scheme of simulate: the sensitivities of the patient,
+    pancreas and PID states with respect to the parameters are propagated through every step
+    using the analytic jacobians of the models. The patient must have a pump.
+
+    Returns
+    -------
+    cost : sum of penalties, as info["pens"].sum() from simulate.
+    grad : numpy array with derivatives with respect to Kp, Ti and Td.
+    """
+    if patient.type == 0:
+        raise ValueError("Patient of type 0 has no pump.")
+    if patient.type != 1 and patient.pancreas_method != "euler":
+        raise ValueError("Sensitivities are only implemented for the euler pancreas.")
+    ds, uIs, uPs, iterations = patient.prepare_inputs(ds, uIs, uPs, iterations)
+    uIs = uIs.astype(float)
+    uPs = uPs.astype(float)
+    iG = patient._idx["G"]
+    iGsc = patient._idx["Gsc"]
+    timestep = patient.timestep
+    e_Kp, e_Ti, e_Td = np.eye(3)
+
+    pump = patient.pumpObj
+    Kp, Ti, Td = pump.Kp, pump.Ti, pump.Td
+    S = np.zeros((len(patient.x), 3)) # sensitivities of patient states
+    S_I = np.zeros(3) # sensitivities of PID state
+    S_yprev = np.zeros(3)
+    if patient.type != 1:
+        pancreas = patient.pancreasObj
+        S_p = np.zeros((len(pancreas.x), 3)) # sensitivities of pancreas states
+
+    cost = patient.glucose_penalty(patient.G)
+    grad = np.zeros(3)
+    for i in range(iterations):
+        d = ds[i%len(ds)]
+        S_G = S[iG]
+
+        # pancreas, as Patient.pancreas
+        u_panc, du_panc = 0, np.zeros(3)
+        if patient.type != 1:
+            G = patient.G
+            u, du = 0, np.zeros(3)
+            for j in range(patient.pancreas_n):
+                dISR, dISR_G = pancreas.ISR_jac(G)
+                du += dISR @ S_p + dISR_G * S_G
+                A = pancreas.jac(G)
+                b = pancreas.input_jac(G)
+                u += pancreas.eval(G)
+                S_p = (pancreas.x > 0)[:, None] * (S_p + pancreas.timestep * (A @ S_p + np.outer(b, S_G)))
+            if u > 0:
+                u_panc, du_panc = u/patient.pancreas_n, du/patient.pancreas_n
+        uP, duP = uPs[i%len(uPs)], np.zeros(3)
+        if np.isnan(uP):
+            uP, duP = u_panc, du_panc
+
+        # pump, as Patient.pump and PID.eval
+        y, S_y = patient.Gsc, S[iGsc]
+        I, yprev = pump.x
+        P = Kp * (y - pump.ybar)
+        dP = e_Kp * (y - pump.ybar) + Kp * S_y
+        dD = (e_Kp * Td + Kp * e_Td) * (y - yprev)/pump.timestep + Kp * Td * (S_y - S_yprev)/pump.timestep
+        dres = dP + S_I + dD
+        res = pump.eval(y)
+        S_I = S_I + (dP/Ti - P/Ti**2 * e_Ti) * pump.timestep
+        S_yprev = S_y
+        u_pump, du_pump = 0, np.zeros(3)
+        if res + patient.us > 0:
+            u_pump, du_pump = res + patient.us, dres
+        uI, duI = uIs[i%len(uIs)], np.zeros(3)
+        if np.isnan(uI):
+            uI, duI = u_pump, du_pump
+
+        # patient
+        A = patient.jac(d = d, uI = uI, uP = uP)
+        B = patient.input_jac(d = d, uI = uI, uP = uP)
+        patient.euler_step(patient.f_func(d = d, uI = uI, uP = uP))
+        patient.update_state(np.maximum(patient.x, 0))
+        S = (patient.x > 0)[:, None] * (S + timestep * (A @ S + np.outer(B[:, 1], duI) + np.outer(B[:, 2], duP)))
+
+        cost += patient.glucose_penalty(patient.G)
+        grad += patient.glucose_penalty_deriv(patient.G) * S[iG]
+    return cost, grad
@@ -0,0 +1,115 @@
+import numpy as np
+import json
+import os
+from .cache import describe
+
+
+class SimulationWriter:
+    """Writes the info dictionaries of a simulation to a directory of .npy files, one per column.
+
+    The files are memory-mapped, so the simulation is written chunk by chunk without holding it in memory.
+    The layout matches the info dictionary of simulate: states, "t" and "pens" have iterations + 1 entries,
+    and "uP", "uI" and "d" have iterations entries. For a PatientBatch every column has one row per patient.
+    meta.json holds the model, type, timestep, state keys and the parameters of the patient, pancreas and pump.
+
+    Parameters
+    ----------
+    path : directory to write to. Existing columns are overwritten.
+    patient : Patient or PatientBatch that is simulated.
+    iterations : number of iterations of the simulation.
+    """
+    def __init__(self, path, patient, iterations):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.iterations = iterations
+        size = getattr(patient, "size", None) # None for a single patient
+        lead = () if size is None else (size,)
+        meta = {
+            "model" : patient.model,
+            "type" : patient.type,
+            "timestep" : float(patient.timestep),
+            "iterations" : iterations,
+            "size" : size,
+            "state_keys" : list(patient.state_keys),
+            "patient" : describe(patient),
+            "pancreas" : describe(patient.pancreasObj) if patient.type != 1 else None,
+            "pump" : describe(patient.pumpObj) if patient.type != 0 else None
+        }
+        with open(os.path.join(path, "meta.json"), "w") as f:
+            json.dump(meta, f)
+        self.columns = {}
+        for key in patient.state_keys + ["t", "pens"]:
+            self.columns[key] = self._open(key, lead + (iterations + 1,))
+        for key in ["uP", "uI", "d"]:
+            self.columns[key] = self._open(key, lead + (iterations,))
+        self.columns["t"][:] = patient.time_arr(iterations + 1) # as simulate and the chunks of simulate_iter
+        for i, key in enumerate(patient.state_keys): # initial state
+            self.columns[key][..., 0] = patient.x[..., i]
+        self.columns["pens"][..., 0] = patient.glucose_penalty(self.columns["G"][..., 0])
+        self.done = 0
+
+    def _open(self, key, shape):
+        return np.lib.format.open_memmap(os.path.join(self.path, key + ".npy"), mode="w+", dtype=float, shape=shape)
+
+    def write(self, info):
+        """Appends info dictionary of the next chunk, without the initial state (as yielded by simulate_iter)."""
+        n = info["uI"].shape[-1]
+        for key, arr in self.columns.items():
+            if key == "t":
+                continue
+            offset = 0 if key in ("uP", "uI", "d") else 1 # states are one ahead of inputs
+            arr[..., self.done + offset:self.done + offset + n] = info[key]
+        self.done += n
+
+    def close(self):
+        """Flushes the columns to disk and returns a SimulationStore for reading them."""
+        for arr in self.columns.values():
+            arr.flush()
+        self.columns = {}
+        return SimulationStore(self.path)
+
+
+class SimulationStore:
+    """Reads a simulation written by SimulationWriter.
+
+    Columns are opened as read-only memory maps, so indexing only reads the parts that are used.
+
+    Example
+    -------
+    store = p.simulate(ds = meals, out = "run1")
+    store.meta["timestep"]
+    day2 = store.window(24*60, 48*60) # dictionary of memory-mapped views
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), "r") as f:
+            self.meta = json.load(f)
+        self.keys = self.meta["state_keys"] + ["t", "pens", "uP", "uI", "d"]
+        self._columns = {}
+
+    def __getitem__(self, key):
+        if key not in self.keys:
+            raise KeyError(key)
+        if key not in self._columns:
+            self._columns[key] = np.load(os.path.join(self.path, key + ".npy"), mmap_mode="r")
+        return self._columns[key]
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def window(self, t0 = None, t1 = None, keys = None):
+        """Returns dictionary of views of the columns for t0 <= t < t1 (in minutes).
+        t is the time base of simulate (Patient.time_arr), so the rows are those where simulate(...)["t"] is in the window.
+        The views are slices of the memory maps, so no data is copied.
+        """
+        t = self["t"]
+        i0 = 0 if t0 is None else int(np.searchsorted(t, t0, side="left"))
+        i1 = len(t) if t1 is None else int(np.searchsorted(t, t1, side="left"))
+        res = {}
+        for key in keys or self.keys:
+            res[key] = self[key][..., i0:min(i1, self[key].shape[-1])]
+        return res
+
+    def info(self):
+        """Returns the whole simulation as an info dictionary of memory maps, like the output of simulate."""
+        return {key: self[key] for key in self.keys}
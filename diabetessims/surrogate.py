@@ -0,0 +1,237 @@
+import numpy as np
+
+PID_KEYS = ("Kp", "Ti", "Td")
+
+
+class GaussianProcess:
+    """Gaussian process regression with a squared exponential kernel and one length scale per input.
+
+    The targets are standardized, and the length scales and the noise are fitted by maximizing
+    the log marginal likelihood. Inputs should be scaled to about [0, 1]. The noise is kept at most
+    1e-5, as the targets are deterministic simulations that the process should nearly interpolate.
+
+    Parameters
+    ----------
+    noise : initial variance of the noise, relative to the variance of the targets.
+    """
+    def __init__(self, noise = 1e-6):
+        self.noise = noise
+        self.length_scales = None
+
+    def _kernel(self, A, B):
+        d = (A[:, None, :] - B[None, :, :]) / self.length_scales
+        return np.exp(-np.sum(d**2, axis=-1)/2)
+
+    def _neg_log_likelihood(self, theta, X, y):
+        self.length_scales, self.noise = np.exp(theta[:-1]), np.exp(theta[-1])
+        K = self._kernel(X, X) + (self.noise + 1e-10) * np.eye(len(X))
+        try:
+            L = np.linalg.cholesky(K)
+        except np.linalg.LinAlgError:
+            return np.inf
+        alpha = np.linalg.solve(L.T, np.linalg.solve(L, y))
+        return y @ alpha / 2 + np.sum(np.log(np.diag(L)))
+
+    def fit(self, X, y):
+        """Fits the process to inputs X (shape (n, d)) and targets y (shape (n,))."""
+        from scipy.optimize import minimize
+        from scipy.linalg import cho_factor, cho_solve
+        self.X = np.asarray(X, dtype=float)
+        y = np.asarray(y, dtype=float)
+        self.y_mean, self.y_std = y.mean(), y.std() or 1
+        ys = (y - self.y_mean) / self.y_std
+        if self.length_scales is None: # later fits start from the last hyperparameters
+            self.length_scales = np.full(self.X.shape[1], 0.3)
+        theta0 = np.log(np.append(self.length_scales, self.noise))
+        bounds = [(np.log(1e-2), np.log(1e2))] * self.X.shape[1] + [(np.log(1e-8), np.log(1e-5))]
+        res = minimize(self._neg_log_likelihood, theta0, args = (self.X, ys), method = "L-BFGS-B", bounds = bounds)
+        theta = res.x if np.isfinite(res.fun) else theta0
+        self.length_scales, self.noise = np.exp(theta[:-1]), np.exp(theta[-1])
+        self._cho = cho_factor(self._kernel(self.X, self.X) + (self.noise + 1e-10) * np.eye(len(self.X)), lower = True)
+        self._alpha = cho_solve(self._cho, ys)
+        self._cho_solve = cho_solve
+        return self
+
+    def predict(self, X):
+        """Returns mean and standard deviation of the process at inputs X (shape (m, d))."""
+        Ks = self._kernel(np.asarray(X, dtype=float), self.X)
+        mean = Ks @ self._alpha
+        var = 1 - np.sum(Ks * self._cho_solve(self._cho, Ks.T).T, axis=-1)
+        return mean * self.y_std + self.y_mean, np.sqrt(np.maximum(var, 0)) * self.y_std
+
+
+class BolusSurrogate:
+    """Cheap emulator of the penalty of Patient.bolus_sim, trained on sampled simulations of one patient.
+
+    The log of the penalty is modelled with a GaussianProcess as a function of the meal size, the bolus
+    and, if PID is True, the PID parameters Kp, Ti and Td. Optimizers query the surrogate, and only the
+    final candidates are simulated (see minimize). Every simulation is added to the training data.
+
+    Parameters
+    ----------
+    patient : Patient to emulate. Its pump parameters are restored after each simulation.
+    bounds : dictionary of (low, high) of the inputs "meal_size", "bolus" and, with PID, "Kp", "Ti" and "Td".
+        Missing inputs get default ranges.
+    n : number of simulations in the initial (latin hypercube) design.
+    h : number of hours to run each simulation for, as in bolus_sim.
+    PID : if True, the pump is used after the bolus, and its parameters are inputs of the surrogate.
+    seed : seed of the random numbers of the design and the candidates.
+
+    Example
+    -------
+    s = BolusSurrogate(p, n = 30)
+    s.refine(10) # simulate where the surrogate is most uncertain
+    u = s.best_bolus(50) # optimal bolus for a 50 g meal, confirmed by simulation
+    """
+    def __init__(self, patient, bounds = None, n = 20, h = 24, PID = False, seed = 0):
+        self.patient = patient
+        self.h = h
+        self.PID = PID
+        self.keys = ["meal_size", "bolus"] + (list(PID_KEYS) if PID else [])
+        defaults = {"meal_size" : (0, 150), "bolus" : (0, 15000), "Kp" : (0, 2), "Ti" : (1, 500), "Td" : (0, 50)}
+        defaults.update(bounds or {})
+        self.bounds = np.array([defaults[key] for key in self.keys], dtype=float)
+        self.rng = np.random.default_rng(seed)
+        self.gp = GaussianProcess()
+        self.X = np.empty((0, len(self.keys)))
+        self.y = np.empty(0)
+        self.add(self._design(n))
+
+    def _design(self, n):
+        """Latin hypercube sample of n points in the bounds"""
+        d = len(self.keys)
+        u = (np.argsort(self.rng.random((d, n)), axis=1).T + self.rng.random((n, d))) / n
+        return self.bounds[:, 0] + u * (self.bounds[:, 1] - self.bounds[:, 0])
+
+    def _scale(self, X):
+        return (X - self.bounds[:, 0]) / (self.bounds[:, 1] - self.bounds[:, 0])
+
+    def simulate(self, X):
+        """Returns penalty of bolus_sim at the rows of X, with columns in the order of self.keys."""
+        p = self.patient
+        X = np.array(X, dtype=float, ndmin=2)
+        saved = [getattr(p.pumpObj, key) for key in PID_KEYS] if self.PID else None
+        phis = np.empty(len(X))
+        try:
+            for i, row in enumerate(X):
+                if self.PID:
+                    for key, value in zip(PID_KEYS, row[2:]):
+                        setattr(p.pumpObj, key, value)
+                phis[i], _, _ = p.bolus_sim(row[1], meal_size = row[0], h = self.h, PID = self.PID)
+        finally:
+            if self.PID:
+                for key, value in zip(PID_KEYS, saved):
+                    setattr(p.pumpObj, key, value)
+            p.full_reset()
+        return phis
+
+    def add(self, X):
+        """Simulates at the rows of X, adds them to the training data and refits. Returns the penalties."""
+        X = np.array(X, dtype=float, ndmin=2)
+        phis = self.simulate(X)
+        self.X = np.vstack([self.X, X])
+        self.y = np.append(self.y, phis)
+        self.gp.fit(self._scale(self.X), np.log(np.maximum(self.y, 1e-12)))
+        return phis
+
+    def predict(self, X):
+        """Returns predicted penalty (the median) at the rows of X and the standard deviation of its log.
+
+        The standard deviation is the uncertainty of the surrogate: the penalty is within a factor
+        exp(2*std) of the prediction with about 95% probability.
+        """
+        mean, std = self.gp.predict(self._scale(np.array(X, dtype=float, ndmin=2)))
+        return np.exp(mean), std
+
+    def _limits(self, limits):
+        """Bounds of the inputs, narrowed to the ranges in the dictionary limits"""
+        bounds = self.bounds.copy()
+        for key, (low, high) in (limits or {}).items():
+            i = self.keys.index(key)
+            bounds[i] = max(low, bounds[i, 0]), min(high, bounds[i, 1])
+            if bounds[i, 0] > bounds[i, 1]:
+                raise ValueError(f"Limits of {key} do not overlap the bounds of the surrogate.")
+        return bounds
+
+    def _candidates(self, n, fixed, limits = None):
+        """n random inputs in the bounds (narrowed to limits), with the inputs in fixed held at their values"""
+        bounds = self._limits(limits)
+        X = bounds[:, 0] + self.rng.random((n, len(self.keys))) * (bounds[:, 1] - bounds[:, 0])
+        for key, value in fixed.items():
+            X[:, self.keys.index(key)] = value
+        return X
+
+    def _minimize_mean(self, x0, fixed, limits = None):
+        """Local minimum of the predicted log penalty over the inputs that are not fixed, starting from x0"""
+        from scipy.optimize import minimize
+        free = [i for i, key in enumerate(self.keys) if key not in fixed]
+        lo, hi = self._limits(limits)[free].T
+        scale = self.bounds[free, 1] - self.bounds[free, 0]
+        x = np.array(x0, dtype=float)
+        def mean(z):
+            x[free] = lo + z * scale
+            return self.gp.predict(self._scale(x[None]))[0][0]
+        res = minimize(mean, (x0[free] - lo)/scale, method = "L-BFGS-B", bounds = list(zip(np.zeros(len(free)), (hi - lo)/scale)))
+        x[free] = lo + res.x * scale
+        return x
+
+    def refine(self, n = 1, candidates = 2000, fixed = None, kappa = None, limits = None):
+        """Active learning: simulates n new points, one at a time, chosen among random candidates.
+
+        Parameters
+        ----------
+        n : number of simulations.
+        candidates : number of random candidates to choose from for each simulation.
+        fixed : dictionary of inputs held fixed, e.g. {"meal_size": 50}.
+        kappa : if None, the candidate where the surrogate is most uncertain is chosen, which improves
+            it everywhere. Otherwise the one with the lowest mean - kappa * std of the log penalty,
+            which improves it near the minimum.
+        limits : dictionary of (low, high) that narrows the range of the candidates of some inputs.
+        """
+        for i in range(n):
+            X = self._candidates(candidates, fixed or {}, limits)
+            mean, std = self.gp.predict(self._scale(X))
+            score = -std if kappa is None else mean - kappa * std
+            self.add(X[np.argmin(score)])
+        return self
+
+    def minimize(self, fixed, candidates = 2000, refine = 5, confirm = 3, kappa = 2, limits = None, rounds = 5):
+        """Minimizes the penalty over the inputs that are not fixed.
+
+        The surrogate is first refined near its minimum with refine simulations (see refine).
+        Then its predicted penalty is minimized locally (L-BFGS-B) from each of the confirm best candidates,
+        the minima are simulated, and from the best of those the refitted surrogate is minimized again,
+        for at most rounds simulations or until the minimum stops moving. The best simulated point is returned.
+        limits : dictionary of (low, high) that narrows the search of some inputs, e.g. {"bolus": (0, 8000)}.
+
+        Returns
+        -------
+        Dictionary of the best inputs, and its simulated penalty.
+        """
+        self.refine(refine, candidates = candidates, fixed = fixed, kappa = kappa, limits = limits)
+        X = self._candidates(candidates, fixed, limits)
+        mean, _ = self.predict(X)
+        best = np.array([self._minimize_mean(x, fixed, limits) for x in X[np.argsort(mean)[:confirm]]])
+        phis = self.add(best)
+        i = np.argmin(phis)
+        x, phi = best[i], phis[i]
+        for j in range(rounds): # minimize the refitted surrogate again from the best simulated point
+            new = self._minimize_mean(x, fixed, limits)
+            if np.max(np.abs(self._scale(new) - self._scale(x))) < 1e-3:
+                break
+            new_phi = self.add(new)[0]
+            if new_phi < phi:
+                x, phi = new, new_phi
+        return dict(zip(self.keys, x)), phi
+
+    def best_bolus(self, meal_size, min_bolus = None, max_bolus = None, **kwargs):
+        """Returns optimal bolus for given meal size(s). With PID, the pump keeps its current parameters.
+        The search is limited to boluses between min_bolus and max_bolus, if given. kwargs are passed to minimize."""
+        if isinstance(meal_size, (np.ndarray, list, tuple)):
+            return np.array([self.best_bolus(m, min_bolus, max_bolus, **kwargs) for m in meal_size])
+        fixed = {"meal_size" : meal_size}
+        if self.PID:
+            fixed.update({key: getattr(self.patient.pumpObj, key) for key in PID_KEYS})
+        low, high = self.bounds[self.keys.index("bolus")]
+        limits = {"bolus" : (low if min_bolus is None else min_bolus, high if max_bolus is None else max_bolus)}
+        return self.minimize(fixed, limits = limits, **kwargs)[0]["bolus"]
@@ -1,63 +1,125 @@
-from scipy.optimize import minimize
 import numpy as np
+import math
+from .schedule import compile_schedule
 
 
 def ReLU(x):
     return x * (x > 0)
 
+def stack_states(*states):
+    """Stacks values of the states along the last axis, so arrays of e.g. G give one state vector per element."""
+    return np.stack(np.broadcast_arrays(*states), axis=-1).astype(float)
+
 def cohen_coon(ybar, t, delay):
         Kp = t/(ybar * delay) * (4/3 + delay/(4 * t))
         Ti = delay * (32 + 6 * delay/t)/(13+8*delay/t)
         Td = 4 * delay / (11 + 2*delay / t)
         return Kp, Ti, Td
 
+def expm(A):
+    """Matrix exponential of A (shape (..., m, m)) by scaling and squaring of a Taylor polynomial.
+    Enough for small, balanced matrices (as in pancreas.advance_exponential and events.py),
+    and much faster than scipy.linalg.expm for them."""
+    dot = np.dot if A.ndim == 2 else np.matmul
+    norm = np.abs(A).sum(axis=-1).max()
+    s = max(0, math.ceil(math.log2(norm / 0.5))) if norm > 0 else 0 # scale until the norm is at most 1/2
+    B = A / 2**s
+    I = np.eye(A.shape[-1])
+    B2 = dot(B, B)
+    B3 = dot(B2, B)
+    B4 = dot(B3, B)
+    # sum of B^j / j! up to j = 8, grouped as (terms below B^4) + B^4 (terms from B^4)
+    E = I + B + B2 / 2 + B3 / 6 + dot(B4, I / 24 + B / 120 + B2 / 720 + B3 / 5040 + B4 / 40320)
+    for i in range(s):
+        E = dot(E, E)
+    return E
+
 def piecewise_linear(b1, a1, b2, a2, x_split):
-    def func(x):
-        if x < x_split:
-            return a1 * x + b1
-        else:
-            return a2 * x + b2
+    """Returns function of x that is a1 * x + b1 for x < x_split and a2 * x + b2 otherwise. x can be an array."""
     def func_arr(xs):
-        if isinstance(xs, (float, int)):
-            return func(xs)
-        ys = []
-        for x in xs:
-            ys.append(func(x))
-        return ys
+        xs = np.asarray(xs)
+        return np.where(xs < x_split, a1 * xs + b1, a2 * xs + b2)[()]
     return func_arr
 
 def piecewise_linear_fit(x, y):
+    """Fits two lines to the points (x, y), with x sorted, split at the point that gives the smallest
+    sum of squared residuals. Each line is fitted to at least 3 points.
+
+    The residuals of all splits are found at once from prefix sums of x, y, x², xy and y²,
+    and the lines of the best split are then fitted with lstsq.
+
+    Returns
+    -------
+    Smallest sum of squared residuals, piecewise_linear function of the fit and index of the split.
+    """
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
     n = len(x)
+    xc, yc = x - x.mean(), y - y.mean() # centering reduces cancellation in the sums
+    sums = np.zeros((5, n + 1))
+    np.cumsum([np.ones(n), xc, yc, xc**2, xc*yc], axis=1, out=sums[:, 1:])
+    sums = np.vstack([sums, np.concatenate([[0], np.cumsum(yc**2)])])
+    split = np.arange(3, n - 2) # left line gets points [0, split), right line [split, n)
+    left = sums[:, split]
+    right = sums[:, -1:] - left
+
+    def rss(m, Sx, Sy, Sxx, Sxy, Syy):
+        """Sums of squared residuals of lines fitted to segments with the given sums, inf if x is constant"""
+        Cxx = Sxx - Sx**2/m
+        Cxy = Sxy - Sx*Sy/m
+        Cyy = Syy - Sy**2/m
+        ok = Cxx > 1e-12 * Sxx
+        return np.where(ok, np.maximum(Cyy - Cxy**2/np.where(ok, Cxx, 1), 0), np.inf)
+
+    res = rss(*left) + rss(*right)
+    if not len(res) or np.isinf(res.min()):
+        raise ValueError("piecewise_linear_fit needs at least 3 points with different x on both sides of a split.")
+    best_spl = int(split[len(res) - 1 - np.argmin(res[::-1])]) # last of equal minima
     A = np.array([np.ones(n), x]).T
-    def cost(split):
-        sol1, res1, _, _ = np.linalg.lstsq(A[:split], y[:split], rcond=None)
-        sol2, res2, _, _ = np.linalg.lstsq(A[split:], y[split:], rcond=None)
-        return res1 + res2, sol1, sol2
-    
-    min_res = 200000000
-
-    for spl in range(n-1):
-        res, sol1, sol2 = cost(spl)
-        if len(res):
-            if min_res >= res:
-                best_spl = spl
-                func = piecewise_linear(*sol1, *sol2, x[spl])
-                min_res = res
-    return min_res, func, best_spl
+    sol1, res1, _, _ = np.linalg.lstsq(A[:best_spl], y[:best_spl], rcond=None)
+    sol2, res2, _, _ = np.linalg.lstsq(A[best_spl:], y[best_spl:], rcond=None)
+    return float(res1.sum() + res2.sum()), piecewise_linear(*sol1, *sol2, x[best_spl]), best_spl
 
-def timestamp_arr(data, timestep, fill = 0, h=24):
-    n = int(h * 60 / timestep)
-    arr = np.empty(n)
-    arr[:] = fill
-    for m in data:
-        if len(m) == 2:
-            idx = int(m[1] / timestep * 60)
-            arr[idx] = m[0]/ timestep
-        else:
-            idx = (np.array(m)[1:3] / timestep * 60).astype(int)
+def bracketed_root(func, a, b, xtol = 1e-10, maxiter = 100):
+    """Finds roots of a vectorized function in the brackets [a, b] with the Illinois (false position) method.
 
-            arr[idx[0]:idx[1]] = m[0]/(idx[1]-idx[0])/timestep
-    return arr
+    func takes an array of x values and returns an array of the same shape, so many independent
+    roots (e.g. one per patient) are found at once. Entries without a sign change in their bracket are nan.
+    """
+    a, b = np.broadcast_arrays(np.asarray(a, dtype=float), np.asarray(b, dtype=float))
+    a, b = a.copy(), b.copy()
+    fa, fb = func(a), func(b)
+    x = np.where(fa == 0, a, np.where(fb == 0, b, np.nan))
+    active = (np.sign(fa) * np.sign(fb) < 0)
+    side = np.zeros(a.shape) # which end was kept last time, to halve its value when it is kept twice
+    for i in range(maxiter):
+        if not active.any():
+            break
+        c = np.where(active, (a * fb - b * fa)/np.where(active, fb - fa, 1), a)
+        fc = func(c)
+        left = active & (np.sign(fc) == np.sign(fa)) # root is in [c, b]
+        right = active & ~left # root is in [a, c]
+        a, fa = np.where(left, c, a), np.where(left, fc, fa)
+        b, fb = np.where(right, c, b), np.where(right, fc, fb)
+        fb = np.where(left & (side == 1), fb/2, fb)
+        fa = np.where(right & (side == -1), fa/2, fa)
+        side = np.where(left, 1, np.where(right, -1, side))
+        x = np.where(active, c, x)
+        active &= (fc != 0) & (np.abs(b - a) > xtol)
+    return x
+
+def timestamp_arr(data, timestep, fill = 0, h=24):
+    """Returns input array for one day of meals or boluses.
+    Rows of data are (amount, time) for amounts given at once or (amount, start, end) for amounts spread
+    over [start, end), with times in hours. See schedule.compile_schedule for several days at once.
+    """
+    if isinstance(data, np.ndarray) and data.ndim == 2:
+        table = np.asarray(data[:, :3], dtype=float)
+    else:
+        table = np.array([list(m[:3]) + [np.nan] * (3 - len(m)) for m in data], dtype=float).reshape(-1, 3)
+    if table.shape[1] == 2:
+        table = np.hstack([table, np.full((len(table), 1), np.nan)])
+    table = np.hstack([np.zeros((len(table), 1)), table]) # all on day 0
+    return compile_schedule(table, timestep, days = 1, fill = fill, h = h).dense()
 
 def filter(arr, minval=None, maxval=None):
     n = len(x)
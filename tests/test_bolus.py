@@ -0,0 +1,30 @@
+import numpy as np
+import pytest
+
+from diabetessims import MVP, HM, Patient
+
+
+@pytest.mark.parametrize("meal_size", [0, 20, 60, 120])
+def test_bolus_penalty_matches_bolus_sim(meal_size):
+    p = Patient(1, MVP)
+    response = p.bolus_response(meal_size, h = 12)
+    boluses = np.array([0, 500, 3000, 9000])
+    phis, pens, G = p.bolus_penalty(boluses, response)
+    for i, u in enumerate(boluses):
+        phi, pen, Gt = p.bolus_sim(u, meal_size, h = 12)
+        np.testing.assert_allclose(G[i], Gt, rtol=1e-12)
+        np.testing.assert_allclose(pens[i], pen, rtol=1e-10, atol=1e-9)
+        np.testing.assert_allclose(phis[i], phi, rtol=1e-12)
+        assert p.bolus_sim(u, meal_size, h = 12, response = response)[0] == phis[i]
+
+
+def test_bolus_response_only_for_mvp_without_pancreas():
+    assert Patient(1, HM).bolus_response(50) is None
+    assert Patient(2, MVP).bolus_response(50) is None
+
+
+def test_bolus_sim_rejects_response_of_other_meal():
+    p = Patient(1, MVP)
+    response = p.bolus_response(50)
+    with pytest.raises(ValueError):
+        p.bolus_sim(1000, 60, response = response)
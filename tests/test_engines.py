@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+
+from diabetessims import MVP, HM, Patient
+
+MODELS = [MVP, HM]
+TYPES = [0, 1, 2]
+
+
+def meal_inputs(p, days = 1):
+    """Three meals a day and, with a pump, a bolus with the first meal"""
+    n = int(days * 24 * 60 / p.timestep)
+    ds = np.zeros(n)
+    for day in range(days):
+        for hour, grams in ((7, 50), (12, 70), (18, 80)):
+            ds[int((day * 24 + hour) * 60 / p.timestep)] = grams / p.timestep
+    uIs = None
+    if p.type != 0:
+        uIs = np.full(n, np.nan)
+        uIs[int(7 * 60 / p.timestep)] = 2000 / p.timestep
+    return ds, uIs, n
+
+
+def assert_same_info(a, b, keys):
+    for key in keys:
+        np.testing.assert_array_equal(np.asarray(a[key]), np.asarray(b[key]), err_msg=key)
+
+
+@pytest.mark.parametrize("model", MODELS)
+@pytest.mark.parametrize("patient_type", TYPES)
+def test_fast_engine_matches_python(model, patient_type):
+    p = Patient(patient_type, model)
+    ds, uIs, n = meal_inputs(p)
+    ref = p.simulate(ds = ds, uIs = uIs, iterations = n)
+    end = p.snapshot()
+    p.full_reset()
+    fast = p.simulate(ds = ds, uIs = uIs, iterations = n, engine = "fast")
+    assert_same_info(fast, ref, p.state_keys + ["t", "uI", "uP", "d", "pens"])
+    assert_same_info(p.snapshot(), end, end.keys()) # pancreas and pump end in the same state
+
+
+@pytest.mark.parametrize("model", MODELS)
+@pytest.mark.parametrize("patient_type", TYPES)
+def test_batch_matches_loop(model, patient_type):
+    from diabetessims import PatientBatch
+    patients = [Patient(patient_type, model, Gbar = Gbar) for Gbar in (5, 6, 7)]
+    ds, uIs, n = meal_inputs(patients[0])
+    uIs = None if uIs is None else np.tile(uIs, (len(patients), 1))
+    batch = PatientBatch(patients)
+    info = batch.simulate(ds = ds[None], uIs = uIs, iterations = n)
+    for i, p in enumerate(patients):
+        ref = p.simulate(ds = ds, uIs = None if uIs is None else uIs[i], iterations = n)
+        assert_same_info({key: value[i] for key, value in info.items() if key != "t"}, ref, p.state_keys + ["uI", "uP", "d", "pens"])
+    np.testing.assert_array_equal(info["t"], ref["t"])
+
+
+@pytest.mark.parametrize("model", MODELS)
+@pytest.mark.parametrize("patient_type", TYPES)
+def test_events_max_skip_one_matches_simulate(model, patient_type):
+    p = Patient(patient_type, model)
+    ds, uIs, n = meal_inputs(p)
+    ref = p.simulate(ds = ds, uIs = uIs, iterations = n)
+    end = p.snapshot()
+    p.full_reset()
+    info = p.simulate(ds = ds, uIs = uIs, iterations = n, integrator = "events", ivp_options = dict(max_skip = 1))
+    assert_same_info(info, ref, p.state_keys + ["t", "uI", "uP", "d", "pens"])
+    assert_same_info(p.snapshot(), end, end.keys())
+    assert info["rhs_evals"] == n
+
+
+@pytest.mark.parametrize("patient_type", TYPES)
+def test_events_skip_the_night(patient_type):
+    p = Patient(patient_type, MVP)
+    ds, uIs, n = meal_inputs(p, days = 2)
+    ref = p.simulate(ds = ds, uIs = uIs, iterations = n)
+    p.full_reset()
+    info = p.simulate(ds = ds, uIs = uIs, iterations = n, integrator = "events")
+    assert info["rhs_evals"] < n / 2
+    assert np.abs(info["G"] - ref["G"]).max() < 0.2 # mostly the error of the euler steps of simulate
@@ -0,0 +1,17 @@
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BUDGET = 2.0 # seconds, about 0.2 s are measured with a warm disk
+HEAVY = ("matplotlib", "scipy.optimize", "scipy.integrate", "numba")
+
+
+def test_import_is_fast_and_lazy():
+    code = "import sys, diabetessims; print(' '.join(m for m in %r if m in sys.modules))" % (HEAVY,)
+    start = time.perf_counter()
+    out = subprocess.run([sys.executable, "-c", code], cwd = ROOT, capture_output = True, text = True, check = True)
+    elapsed = time.perf_counter() - start
+    assert out.stdout.split() == []
+    assert elapsed < BUDGET
@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+
+from diabetessims import timestamp_arr, compile_schedule, Schedule
+
+
+def timestamp_arr_loop(data, timestep, fill = 0, h = 24):
+    """timestamp_arr as it was before the schedule compiler, for non-overlapping entries"""
+    n = int(h * 60 / timestep)
+    arr = np.empty(n)
+    arr[:] = fill
+    for m in data:
+        if len(m) == 2:
+            idx = int(m[1] / timestep * 60)
+            arr[idx] = m[0]/ timestep
+        else:
+            idx = (np.array(m)[1:3] / timestep * 60).astype(int)
+            arr[idx[0]:idx[1]] = m[0]/(idx[1]-idx[0])/timestep
+    return arr
+
+
+DAY = [(50, 6, 6.25), (70, 12.5, 12.75), (80, 18.5, 18.75)]
+BOLUSES = [(727.8, 6), (1222.9, 12.5), (900, 18.5)]
+
+
+@pytest.mark.parametrize("timestep", [1, 5, 0.5])
+@pytest.mark.parametrize("data, fill", [(DAY, 0), (BOLUSES, 0), (BOLUSES, np.nan), (DAY[:1] + BOLUSES[1:], 0), ([], 0)])
+def test_timestamp_arr_matches_loop(data, fill, timestep):
+    np.testing.assert_array_equal(timestamp_arr(data, timestep, fill = fill), timestamp_arr_loop(data, timestep, fill = fill))
+
+
+def test_compile_schedule_matches_days_of_timestamp_arr():
+    table = [(day, *row) for day in range(3) for row in DAY] + [(1, 30, 15)]
+    schedule = compile_schedule(table, 1)
+    days = [timestamp_arr(DAY, 1), timestamp_arr(DAY + [(30, 15)], 1), timestamp_arr(DAY, 1)]
+    np.testing.assert_array_equal(schedule.dense(), np.concatenate(days))
+
+
+def test_compile_schedule_rejects_other_widths():
+    with pytest.raises(ValueError):
+        compile_schedule([(0, 50), (0, 70, 12)], 1)
+
+
+def test_schedule_iterates_as_dense():
+    s = Schedule([0, 3, 5, 9], [0, 2.5, np.nan])
+    np.testing.assert_array_equal(np.array(list(s)), s.dense())
+    np.testing.assert_array_equal(s.value_at(np.arange(9)), s.dense())
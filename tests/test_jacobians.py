@@ -0,0 +1,107 @@
+import numpy as np
+import pytest
+
+from diabetessims import MVP, HM, Patient
+from diabetessims.pancreas import PKPM
+from diabetessims.sensitivity import pid_cost_grad
+
+REGIMES = (3.0, 6.0, 12.0) # G below Gl, between Gl and Gu (4.5 and 9), and above Gu
+
+
+def central_diff(f, x, eps = 1e-6):
+    """Returns central finite difference Jacobian of f at x, with columns d(f)/d(x_j)."""
+    x = np.array(x, dtype=float)
+    cols = []
+    for j in range(len(x)):
+        h = eps * max(abs(x[j]), 1)
+        xp, xm = x.copy(), x.copy()
+        xp[j] += h
+        xm[j] -= h
+        cols.append((np.asarray(f(xp)) - np.asarray(f(xm))) / (2*h))
+    return np.stack(cols, axis=-1)
+
+
+def perturbed_state(obj, rng):
+    """Steady state of obj scaled by random factors, so no derivative vanishes by symmetry"""
+    return obj.x * rng.uniform(0.8, 1.2, len(obj.x)) + rng.uniform(0.01, 0.1, len(obj.x))
+
+
+@pytest.mark.parametrize("model", [MVP, HM])
+@pytest.mark.parametrize("G", REGIMES)
+def test_patient_jacobians(model, G):
+    p = Patient(0, model)
+    rng = np.random.default_rng(0)
+    x = perturbed_state(p, rng)
+    x[p._idx["G"]] = G
+    u = np.array([5.0, 20.0, 10.0]) # d, uI, uP
+
+    def f_state(x):
+        p.x[:] = x
+        return p.f_func(*u)
+
+    def f_input(u):
+        p.x[:] = x
+        return p.f_func(*u)
+
+    J_fd = central_diff(f_state, x)
+    B_fd = central_diff(f_input, u)
+    p.x[:] = x
+    np.testing.assert_allclose(p.jac(*u), J_fd, rtol=1e-6, atol=1e-9)
+    np.testing.assert_allclose(p.input_jac(*u), B_fd, rtol=1e-6, atol=1e-9)
+
+
+@pytest.mark.parametrize("patient_type", [0, 2])
+@pytest.mark.parametrize("G", REGIMES)
+def test_pancreas_jacobians(patient_type, G):
+    pk = PKPM(patient_type = patient_type, Gbar = 6)
+    x = perturbed_state(pk, np.random.default_rng(1))
+
+    def f_state(x):
+        pk.x[:] = x
+        return pk.sys(G)[0]
+
+    def isr_state(x):
+        pk.x[:] = x
+        return pk.sys(G)[1]
+
+    def f_input(g):
+        pk.x[:] = x
+        return pk.sys(g[0])[0]
+
+    def isr_input(g):
+        pk.x[:] = x
+        return pk.sys(g[0])[1]
+
+    J_fd = central_diff(f_state, x)
+    dISR_fd = central_diff(isr_state, x)
+    b_fd = central_diff(f_input, [G])[:, 0]
+    dISR_G_fd = central_diff(isr_input, [G])[0]
+    pk.x[:] = x
+    scale = np.abs(J_fd).max()
+    np.testing.assert_allclose(pk.jac(G), J_fd, rtol=1e-6, atol=1e-7 * scale)
+    np.testing.assert_allclose(pk.input_jac(G), b_fd, rtol=1e-6, atol=1e-9)
+    dISR, dISR_G = pk.ISR_jac(G)
+    np.testing.assert_allclose(dISR, dISR_fd, rtol=1e-6, atol=1e-12)
+    np.testing.assert_allclose(dISR_G, dISR_G_fd, rtol=1e-6, atol=1e-12)
+
+
+@pytest.mark.parametrize("patient_type", [1, 2])
+def test_pid_cost_grad(patient_type):
+    p = Patient(patient_type, MVP)
+    iterations = int(6 * 60 / p.timestep)
+    ds = np.zeros(iterations)
+    ds[0] = 50 / p.timestep # 50 g meal
+    params = np.array([p.pumpObj.Kp, p.pumpObj.Ti, p.pumpObj.Td])
+
+    def cost(params):
+        p.set_PID_params(params)
+        p.full_reset()
+        return p.simulate(ds = ds, iterations = iterations)["pens"].sum()
+
+    # the cost is large, so a larger step keeps the rounding error of the small Td derivative down
+    grad_fd = central_diff(lambda q: [cost(q)], params, eps = 1e-4)[0]
+    p.set_PID_params(params)
+    p.full_reset()
+    c, grad = pid_cost_grad(p, ds = ds, iterations = iterations)
+    np.testing.assert_allclose(c, cost(params), rtol=1e-12)
+    np.testing.assert_allclose(grad, grad_fd, rtol=1e-6)
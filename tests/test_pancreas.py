@@ -0,0 +1,26 @@
+import numpy as np
+import pytest
+
+from diabetessims import MVP, HM, Patient
+from diabetessims import pancreas
+
+
+@pytest.mark.parametrize("model", [MVP, HM])
+def test_exponential_is_as_accurate_as_default_euler(model):
+    ds = np.zeros(24 * 60)
+    ds[[7 * 60, 12 * 60, 18 * 60]] = 60
+    ref = Patient(2, model, pancreas_n = 100).simulate(ds = ds)["G"]
+    euler = Patient(2, model).simulate(ds = ds)["G"] # pancreas_n = 10
+    exponential = Patient(2, model, pancreas_method = "exponential", pancreas_n = 1).simulate(ds = ds)["G"]
+    assert np.abs(exponential - ref).max() <= np.abs(euler - ref).max()
+
+
+def test_exponential_batch_matches_single():
+    pk = pancreas.PKPM(patient_type = 2, Gbar = 6)
+    G = np.array([3.0, 6.0, 12.0])
+    x = np.tile(pk.x, (len(G), 1))
+    isr = pancreas.advance_exponential(pk, x, G, 3)
+    for i, g in enumerate(G):
+        xi = pk.x.copy()
+        np.testing.assert_allclose(pancreas.advance_exponential(pk, xi, g, 3), isr[i], rtol=1e-12)
+        np.testing.assert_allclose(xi, x[i], rtol=1e-12, atol=1e-15)
@@ -0,0 +1,34 @@
+import numpy as np
+import pickle
+import pytest
+
+from diabetessims import MVP, HM, Patient
+
+
+@pytest.mark.parametrize("model", [MVP, HM])
+@pytest.mark.parametrize("patient_type", [0, 1, 2])
+def test_restore_repeats_simulation(model, patient_type):
+    p = Patient(patient_type, model)
+    n = int(6 * 60 / p.timestep)
+    ds = np.zeros(n)
+    ds[0] = 60 / p.timestep
+    p.simulate(ds = ds, iterations = n)
+    snap = pickle.loads(pickle.dumps(p.snapshot())) # snapshots can be stored
+    first = p.simulate(ds = ds, iterations = n)
+    end = p.snapshot()
+    p.restore(snap)
+    second = p.simulate(ds = ds, iterations = n)
+    np.testing.assert_array_equal(second["G"], first["G"])
+    np.testing.assert_array_equal(second["uI"], first["uI"])
+    np.testing.assert_array_equal(second["uP"], first["uP"])
+    for key in end:
+        np.testing.assert_array_equal(p.snapshot()[key], end[key])
+
+
+def test_snapshot_is_a_copy():
+    p = Patient(2, MVP)
+    snap = p.snapshot()
+    before = {key: value.copy() for key, value in snap.items()}
+    p.simulate(iterations = 100, ds = 1)
+    for key in snap:
+        np.testing.assert_array_equal(snap[key], before[key])
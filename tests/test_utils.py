@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+from diabetessims.utils import piecewise_linear, piecewise_linear_fit
+
+
+def piecewise_linear_fit_loop(x, y):
+    """piecewise_linear_fit as it was before the prefix sums, with one lstsq per split"""
+    n = len(x)
+    A = np.array([np.ones(n), x]).T
+    min_res = 200000000
+    for spl in range(n-1):
+        sol1, res1, _, _ = np.linalg.lstsq(A[:spl], y[:spl], rcond=None)
+        sol2, res2, _, _ = np.linalg.lstsq(A[spl:], y[spl:], rcond=None)
+        res = res1 + res2
+        if len(res):
+            if min_res >= res:
+                best_spl = spl
+                func = piecewise_linear(*sol1, *sol2, x[spl])
+                min_res = res
+    return min_res, func, best_spl
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_piecewise_linear_fit_matches_loop(seed):
+    rng = np.random.default_rng(seed)
+    n = rng.integers(8, 60)
+    x = np.sort(rng.uniform(0, 100, n))
+    x_split = rng.uniform(20, 80)
+    y = np.where(x < x_split, 2 * x + 5, -x + 3 * x_split + 5) + rng.normal(0, 3, n)
+    res, func, spl = piecewise_linear_fit(x, y)
+    ref_res, ref_func, ref_spl = piecewise_linear_fit_loop(x, y)
+    assert spl == ref_spl
+    np.testing.assert_allclose(res, ref_res[0], rtol=1e-9)
+    np.testing.assert_allclose(func(x), ref_func(x), rtol=1e-9)
+
+
+def test_piecewise_linear_is_vectorized():
+    func = piecewise_linear(1, 2, 3, 4, 5)
+    np.testing.assert_array_equal(func(np.array([0, 4, 5, 6])), [1, 9, 23, 27])
+    assert np.ndim(func(4.0)) == 0
+
+
+def test_piecewise_linear_fit_needs_enough_points():
+    with pytest.raises(ValueError):
+        piecewise_linear_fit(np.arange(5.0), np.arange(5.0))